@@ -39,6 +39,15 @@ define('db', default={'pool_id': "EyeStorm", 'host': "localhost",
                       'port': 27017, 'maxcached': 30, 'maxconnections': 60,
                       'dbname': "eyestorm"},
        help="asyncmongo.Client parameters")
+# named pools besides the 'default' one (`db`), {name: asyncmongo.Client
+# parameters}; the parameters not given are taken from `db`. Models pick
+# them through `_pool`/`_read_pool`, see eyestorm.objects.Db
+define('db_pools', default={}, help="Additional named mongo pools")
+# per collection latency/documents/errors of the mongo operations and pools
+# occupancy, see eyestorm.metrics; measuring the BSON size of the documents
+# read costs an encoding per document
+define('mongo_metrics', default=True)
+define('mongo_metrics_bytes', default=False)
 
 define('debug', default=True,
        help="See http://www.tornadoweb.org/documentation/autoreload.html")
@@ -69,12 +78,29 @@ define('translations_path', default=False, type=str,
 define('translations_domain', default=False, type=str,
        help="See translations_path")
 
+# mongo, memory or cookie (see eyestorm.sessions)
+define('sessions_backend', default="mongo")
 define('sessions_store_collection', default="eyestorm_sessions")
 define('sessions_name', default="eyestorm_sid")
 #days
 define('sessions_expiration', default=1)
 #minutes
 define('sesssions_lifetime', default=25)
+# fraction of sesssions_lifetime, the expiration is only pushed forward
+# (and so written) once the remaining lifetime drops below it
+define('sessions_refresh_threshold', default=0.5)
+# per process cached sessions (0 disables the cache)
+define('sessions_cache_size', default=0)
+# max sessions kept by the memory backend
+define('sessions_memory_size', default=10000)
+# let mongo expire the sessions through a TTL index on `__expires`,
+# otherwise (or if the index can't be created) sessions_cleaner removes
+# up to sessions_clean_batch expired sessions per run
+define('sessions_ttl_index', default=True)
+define('sessions_clean_batch', default=500)
+# db_pools the mongo sessions are hash sharded over (by _id), none by
+# default (read when the application starts); see eyestorm.sharding
+define('sessions_shards', default=[])
 
 
 _looper = tornado.ioloop.IOLoop.instance()
@@ -121,6 +147,7 @@ from objects import singleton, Persistable, Collection
 from model import Entity, Entities
 
 from web import routes
+from sessions import get_session_backend
 
 
 class Application(tornado.web.Application):
@@ -153,6 +180,8 @@ class Application(tornado.web.Application):
             tornado.locale.load_gettext_translations(options.translations_path,
                                                    options.translations_domain)
 
+        get_session_backend().setup()
+
         application = tornado.httpserver.HTTPServer(self)
         application.listen(options.port, address=options.address)
 
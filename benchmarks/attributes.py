@@ -0,0 +1,92 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per field write cost: the compiled `_schema` functions against the
+`Attribute.validate`/`cast` dispatch they replaced.
+
+    python benchmarks/attributes.py [iterations]
+
+(with the eyestorm package importable)
+"""
+
+import sys
+import timeit
+
+from eyestorm.model import Entity, model, String, Integer, Float, Boolean, \
+                           PrimaryKey, Reference, is_a
+from eyestorm.model.exceptions import InvalidAttribute
+
+
+@model
+class Author(Entity):
+
+    _attributes = {
+        '_id': PrimaryKey()
+    }
+
+
+@model
+class Post(Entity):
+
+    _attributes = {
+        'title': String(max_length=200),
+        'views': Integer(min_value=0),
+        'score': Float(),
+        'published': Boolean(),
+        'author': is_a('Author')
+    }
+
+
+VALUES = {
+    'title': u"Benchmarking attributes",
+    'views': 1000,
+    'score': 4.5,
+    'published': True,
+    'author': '50a0c6d8e4b0a2f1c3d4e5f6'
+}
+
+
+def dispatch(spec, name, value):
+    # the write path before `_schema`
+    if spec.validate(value):
+        if isinstance(spec, Reference) \
+                and isinstance(spec.reference, PrimaryKey):
+            return str(value)
+        return spec.cast(value)
+    raise InvalidAttribute(name, value)
+
+
+def main(iterations=200000):
+    print "%-10s %12s %12s %8s" % ("field", "dispatch", "compiled",
+                                   "speedup")
+    for name in sorted(VALUES):
+        spec = Post._attributes[name]
+        compiled = Post._schema[name]
+        value = VALUES[name]
+        assert dispatch(spec, name, value) == compiled(value)
+        before = min(timeit.repeat(lambda: dispatch(spec, name, value),
+                                   number=iterations, repeat=3))
+        after = min(timeit.repeat(lambda: compiled(value),
+                                  number=iterations, repeat=3))
+        print "%-10s %11.3fs %11.3fs %7.1fx" % (name, before, after,
+                                                before / after)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
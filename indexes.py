@@ -0,0 +1,215 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory indexes over the documents loaded in a `Collection`.
+"""
+
+
+from bisect import bisect_left, bisect_right
+
+
+_missing = object()
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item))
+                            for key, item in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+class between(object):
+    """Range condition for `Collection.get_by_attribute`, either bound can
+    be None (open)."""
+
+    def __init__(self, low=None, high=None, include_low=True,
+                 include_high=True):
+        self.low = low
+        self.high = high
+        self.include_low = include_low
+        self.include_high = include_high
+
+
+class HashIndex(object):
+    """Equality index on one attribute, or several (compound)."""
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self._entries = {}
+
+    def _key(self, document):
+        values = []
+        for attribute in self.attributes:
+            value = document.get(attribute, _missing)
+            if value is _missing:
+                return _missing
+            values.append(_hashable(value))
+        return tuple(values)
+
+    def add(self, position, document):
+        key = self._key(document)
+        if key is not _missing:
+            self._entries.setdefault(key, set()).add(position)
+
+    def remove(self, position, document):
+        key = self._key(document)
+        positions = self._entries.get(key)
+        if positions:
+            positions.discard(position)
+            if not positions:
+                del self._entries[key]
+
+    def build(self, documents):
+        for position, document in documents:
+            self.add(position, document)
+
+    def lookup(self, *values):
+        key = tuple(_hashable(value) for value in values)
+        return self._entries.get(key, set())
+
+    def keys(self):
+        return [key[0] if len(key) == 1 else key for key in self._entries]
+
+
+class SortedIndex(object):
+    """Ordered index on one attribute, for range queries."""
+
+    def __init__(self, attribute):
+        self.attributes = (attribute,)
+        self._keys = []
+        self._positions = []
+
+    def build(self, documents):
+        attribute = self.attributes[0]
+        entries = sorted((_hashable(document[attribute]), position)
+                         for position, document in documents
+                         if attribute in document)
+        self._keys = [key for key, position in entries]
+        self._positions = [position for key, position in entries]
+
+    def add(self, position, document):
+        key = document.get(self.attributes[0], _missing)
+        if key is _missing:
+            return
+        key = _hashable(key)
+        index = bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        self._positions.insert(index, position)
+
+    def remove(self, position, document):
+        key = document.get(self.attributes[0], _missing)
+        if key is _missing:
+            return
+        key = _hashable(key)
+        index = bisect_left(self._keys, key)
+        while index < len(self._keys) and self._keys[index] == key:
+            if self._positions[index] == position:
+                del self._keys[index]
+                del self._positions[index]
+                return
+            index += 1
+
+    def range(self, condition):
+        start, end = 0, len(self._keys)
+        if condition.low is not None:
+            bisect = bisect_left if condition.include_low else bisect_right
+            start = bisect(self._keys, condition.low)
+        if condition.high is not None:
+            bisect = bisect_right if condition.include_high else bisect_left
+            end = bisect(self._keys, condition.high)
+        return set(self._positions[start:end])
+
+
+class Indexes(object):
+    """The indexes of a list of documents.
+
+    Indexes are built on first use and then maintained by `add`/`remove`.
+    Documents are identified by their position in the insertion order, so
+    results always come back in the list order.
+    """
+
+    def __init__(self, documents):
+        self._documents = {}
+        self._positions = {}
+        self._next = 0
+        self._indexes = {}
+        for document in documents:
+            self.add(document)
+
+    def add(self, document):
+        position = self._next
+        self._next += 1
+        self._documents[position] = document
+        self._positions[id(document)] = position
+        for index in self._indexes.itervalues():
+            index.add(position, document)
+
+    def remove(self, document):
+        position = self._positions.pop(id(document), None)
+        if position is None:
+            return
+        del self._documents[position]
+        for index in self._indexes.itervalues():
+            index.remove(position, document)
+
+    def get_index(self, attributes, sorted=False):
+        key = (tuple(attributes), sorted)
+        if not key in self._indexes:
+            if sorted:
+                index = SortedIndex(attributes[0])
+            else:
+                index = HashIndex(tuple(attributes))
+            index.build(self._documents.iteritems())
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    def group(self, attribute):
+        """{value: [documents]} by the values of `attribute`."""
+        index = self.get_index((attribute,))
+        return dict((key[0], [self._documents[position]
+                              for position in sorted(positions)])
+                    for key, positions in index._entries.iteritems())
+
+    def find(self, conditions):
+        """Documents matching every condition (`name=value` or
+        `name=between(...)`); equalities use a compound index when one was
+        created for exactly those attributes."""
+        equalities = dict((name, value)
+                          for name, value in conditions.iteritems()
+                          if not isinstance(value, between))
+        candidates = []
+        compound = tuple(sorted(equalities))
+        if len(compound) > 1 and (compound, False) in self._indexes:
+            candidates.append(self._indexes[(compound, False)].lookup(
+                *[equalities[name] for name in compound]))
+        else:
+            for name, value in equalities.iteritems():
+                candidates.append(self.get_index((name,)).lookup(value))
+        for name, value in conditions.iteritems():
+            if isinstance(value, between):
+                candidates.append(self.get_index((name,), True).range(value))
+        if not candidates:
+            return [self._documents[position]
+                    for position in sorted(self._documents)]
+        candidates.sort(key=len)
+        positions = candidates[0].intersection(*candidates[1:])
+        return [self._documents[position] for position in sorted(positions)]
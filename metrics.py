@@ -0,0 +1,183 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import time
+
+from bson import BSON
+from asyncmongo.errors import TooManyConnections
+
+from eyestorm import options
+from eyestorm.utils import singleton, Histogram
+
+
+# percentage of `maxconnections` in use
+_OCCUPANCY_BOUNDS = (10, 25, 50, 75, 90, 100)
+
+@singleton
+class MongoMetrics(object):
+    """Process-wide (singleton) instrumentation of what is sent to Mongo.
+
+    Every find, find_one, insert, update and remove of the `CollectionHandle`s
+    (so of every `Collection`, `Entity` and `MongoHelper`) and every command
+    sent through `send_command` is recorded per collection and operation:
+    latency histogram (milliseconds), documents returned, their BSON size
+    (only with `mongo_metrics_bytes`, asyncmongo doesn't tell the bytes read),
+    errors and operations refused because the pool was full.
+
+    asyncmongo never waits for a free connection, it raises
+    TooManyConnections right away, so the pools report their occupancy
+    (sampled on every operation) and those rejections instead of a wait time.
+
+    Listeners added with `add_listener` get `(collection, operation, seconds,
+    documents, error)` once every operation completes, e.g. to forward them
+    to statsd.
+    """
+
+    def __init__(self):
+        self._operations = {}
+        self._pools = {}
+        self._listeners = []
+
+    def is_enabled(self):
+        return options.mongo_metrics
+
+    def watch_pool(self, name, client):
+        """Samples the occupancy of the pool of the asyncmongo `client`."""
+        connections = getattr(client, '_pool', None)
+        if not hasattr(connections, '_connections'):
+            logging.warning("Can't watch the '%s' pool occupancy", name)
+            return
+        self._pools[name] = {'connections': connections, 'peak': 0,
+                             'occupancy': Histogram(_OCCUPANCY_BOUNDS)}
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _get_operation(self, collection, operation):
+        key = (collection, operation)
+        if key not in self._operations:
+            self._operations[key] = {'latency': Histogram(), 'documents': 0,
+                                     'bytes': 0, 'errors': 0, 'rejected': 0}
+        return self._operations[key]
+
+    def _sample_pools(self):
+        for pool in self._pools.itervalues():
+            connections = pool['connections']
+            in_use = connections._connections
+            pool['peak'] = max(pool['peak'], in_use)
+            if connections._maxconnections:
+                pool['occupancy'].record(
+                            100.0 * in_use / connections._maxconnections)
+
+    def timed(self, collection, operation, callback):
+        """Wraps the `callback(result, error)` of an operation starting now
+        so it is recorded once completed (returns `callback` as is when
+        disabled or not callable)."""
+        if not options.mongo_metrics or not callable(callback):
+            return callback
+        self._sample_pools()
+        started = time.time()
+
+        def _callback(*args, **kwargs):
+            try:
+                self.record(collection, operation, time.time() - started,
+                            args[0] if args else kwargs.get('response'),
+                            kwargs.get('error', args[1] if len(args) > 1
+                                                         else None))
+            except Exception:
+                logging.exception("Couldn't record %s on %s", operation,
+                                  collection)
+            callback(*args, **kwargs)
+        return _callback
+
+    def record(self, collection, operation, seconds, result=None,
+               error=None):
+        stats = self._get_operation(collection, operation)
+        stats['latency'].record(seconds * 1000)
+        documents = 0
+        if error:
+            stats['errors'] += 1
+        elif operation == 'find' and isinstance(result, list):
+            documents = len(result)
+        elif operation == 'find_one' and result is not None:
+            documents = 1
+            result = [result]
+        if documents:
+            stats['documents'] += documents
+            if options.mongo_metrics_bytes:
+                stats['bytes'] += sum(len(BSON.encode(document))
+                                      for document in result)
+        for listener in self._listeners:
+            listener(collection, operation, seconds, documents, error)
+
+    def reject(self, collection, operation):
+        self._get_operation(collection, operation)['rejected'] += 1
+
+    def stats(self):
+        """{collection: {operation: {latency, documents, bytes, errors,
+        rejected}}}, latencies being `Histogram.stats()` in milliseconds."""
+        stats = {}
+        for (collection, operation), values in self._operations.iteritems():
+            values = dict(values, latency=values['latency'].stats())
+            stats.setdefault(collection, {})[operation] = values
+        return stats
+
+    def pool_stats(self):
+        """{pool: {in_use, idle, max, peak, occupancy}}, occupancy being the
+        `Histogram.stats()` of the sampled percentage of `max` in use."""
+        stats = {}
+        for name, pool in self._pools.iteritems():
+            connections = pool['connections']
+            stats[name] = {'in_use': connections._connections,
+                           'idle': len(connections._idle_cache),
+                           'max': connections._maxconnections,
+                           'peak': pool['peak'],
+                           'occupancy': pool['occupancy'].stats()}
+        return stats
+
+    def reset(self):
+        self._operations = {}
+        for pool in self._pools.itervalues():
+            pool['peak'] = 0
+            pool['occupancy'] = Histogram(_OCCUPANCY_BOUNDS)
+
+
+def send(method, collection, operation, *args, **kwargs):
+    """Calls the asyncmongo `method` (its `callback` keyword being timed),
+    counting the operations refused by a full pool."""
+    metrics = MongoMetrics()
+    kwargs['callback'] = metrics.timed(collection, operation,
+                                       kwargs.get('callback'))
+    try:
+        method(*args, **kwargs)
+    except TooManyConnections:
+        metrics.reject(collection, operation)
+        raise
+
+
+def send_command(db, command, collection, callback=None, **kwargs):
+    """`db.command(command, collection, ...)`, instrumented as the `command`
+    operation of `collection`."""
+    send(db.command, collection, command, command, collection,
+         callback=callback, **kwargs)
@@ -33,3 +33,4 @@ from attributes import *
 
 from entity import Entity
 from entities import Entities
+from references import ReferenceLoader
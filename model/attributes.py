@@ -18,6 +18,9 @@
 # along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
 
 from bson import ObjectId
+from bson.errors import InvalidId
+
+from exceptions import InvalidAttribute
 
 from pprint import pprint
 
@@ -51,6 +54,22 @@ class Attribute(object):
             return False
         return self.validate_length(value)
 
+    def compile(self, name):
+        """Returns a function that validates and casts a value for the
+        `name` field in a single call, raising `InvalidAttribute`.
+
+        Used by the Entity metaclass to build the model `_schema` once;
+        subclasses flatten their `validate` chain here.
+        """
+        validate = self.validate
+        cast = self.cast
+
+        def validate_and_cast(value):
+            if validate(value):
+                return cast(value)
+            raise InvalidAttribute(name, value)
+        return validate_and_cast
+
 
 class String(Attribute):
 
@@ -65,6 +84,20 @@ class String(Attribute):
             return isinstance(value, basestring)
         return False
 
+    def compile(self, name):
+        min_length = self.min_length
+        max_length = self.max_length
+
+        def validate_and_cast(value):
+            if isinstance(value, basestring) \
+                    and (not min_length or len(value) >= min_length) \
+                    and (not max_length or len(value) <= max_length):
+                if isinstance(value, unicode):
+                    return value
+                return unicode(value, 'utf-8')
+            raise InvalidAttribute(name, value)
+        return validate_and_cast
+
 
 class Number(Attribute):
 
@@ -85,6 +118,22 @@ class Number(Attribute):
             return self.validate_range(value)
         return False
 
+    def compile(self, name):
+        if self.min_length or self.max_length:
+            return super(Number, self).compile(name)
+        null = self.null
+        min_value = self.min_value
+        max_value = self.max_value
+        cast = self.cast
+
+        def validate_and_cast(value):
+            if (null or value is not None) \
+                    and (not min_value or value >= min_value) \
+                    and (not max_value or value <= max_value):
+                return cast(value)
+            raise InvalidAttribute(name, value)
+        return validate_and_cast
+
 
 class Integer(Number):
 
@@ -103,6 +152,17 @@ class Boolean(Attribute):
     def cast(self, value):
         return bool(value)
 
+    def compile(self, name):
+        if self.min_length or self.max_length:
+            return super(Boolean, self).compile(name)
+        null = self.null
+
+        def validate_and_cast(value):
+            if null or value is not None:
+                return bool(value)
+            raise InvalidAttribute(name, value)
+        return validate_and_cast
+
 
 class Array(Attribute):
 
@@ -156,11 +216,22 @@ class PrimaryKey(Attribute):
         except:
             return False
 
+    def compile(self, name):
+        def validate_and_cast(value):
+            try:
+                return ObjectId(value)
+            except (InvalidId, TypeError):
+                raise InvalidAttribute(name, value)
+        return validate_and_cast
+
 
 # References
 
 from eyestorm.model import _models
 
+# `_id` of the models not declaring it
+_default_primary_key = PrimaryKey()
+
 
 class Reference(Attribute):
 
@@ -176,7 +247,45 @@ class Reference(Attribute):
 
     @property
     def reference(self):
-        return _models[self.model_name]._attributes[self.attribute]
+        """The referenced attribute, an undeclared `_id` being the default
+        ObjectId one."""
+        attributes = _models[self.model_name]._attributes
+        if self.attribute == '_id' and '_id' not in attributes:
+            return _default_primary_key
+        return attributes[self.attribute]
+
+    def _get_validator(self):
+        return self.validate
+
+    def compile(self, name):
+        """References are resolved once; when the referenced model is not
+        registered yet (forward or self references), or the referenced
+        attribute isn't declared, resolution happens on the first write
+        instead."""
+        model = _models.get(self.model_name)
+        if model is not None and (self.attribute == '_id'
+                                  or self.attribute in model._attributes):
+            return self._compile_resolved(name)
+        resolved = []
+
+        def validate_and_cast(value):
+            if not resolved:
+                resolved.append(self._compile_resolved(name))
+            return resolved[0](value)
+        return validate_and_cast
+
+    def _compile_resolved(self, name):
+        validate = self._get_validator()
+        if isinstance(self.reference, PrimaryKey):
+            cast = str
+        else:
+            cast = self.cast
+
+        def validate_and_cast(value):
+            if validate(value):
+                return cast(value)
+            raise InvalidAttribute(name, value)
+        return validate_and_cast
 
 
 class ReferenceOneToOne(Reference):
@@ -184,6 +293,9 @@ class ReferenceOneToOne(Reference):
     def validate(self, value):
         return self.reference.validate(value)
 
+    def _get_validator(self):
+        return self.reference.validate
+
 
 class ReferenceOneToMany(Reference):
 
@@ -193,6 +305,9 @@ class ReferenceOneToMany(Reference):
 
     def validate(self, value):
         return self.reference.validate(value)
+
+    def _get_validator(self):
+        return self.reference.validate
         # if isinstance(self.reference, ReferenceManyToOne):
         #     return self.reference.validate_item(value)
         # return False
@@ -20,27 +20,119 @@
 from eyestorm.objects import Collection
 
 from entity import Entity
+from references import ReferenceLoader, populate
 
 
 class Entities(Collection):
 
     _entity = Entity
 
+    def __init__(self):
+        super(Entities, self).__init__()
+        self._entities = {}
+        self._hydrated = None
+
     def __getitem__(self, index):
+        if isinstance(index, slice):
+            return EntitiesView(self, *index.indices(len(self._data)))
+        if self._hydrated is not self._data:
+            # `_data` was replaced (load, set_items...), drop the stale ones
+            self._entities = {}
+            self._hydrated = self._data
+        if index < 0:
+            index += len(self._data)
+            if index < 0:
+                raise IndexError(index - len(self._data))
+        if index in self._entities:
+            return self._entities[index]
         data = self._data[index]
-        entity = getattr(self.__class__, '_entity')()
-        entity._set_collection(self.get_collection_name())
+        entity = self.__class__._entity()
+        entity._set_collection(self._collection_name, self._collection)
         entity.set_attributes(data, True, True)
+        entity._projection = self._projection
+        if '_id' in data:
+            entity.operate.set_criteria(entity._get_spec())
+        self._entities[index] = entity
         return entity
 
+    def remove_items(self, items):
+        super(Entities, self).remove_items(items)
+        if self._hydrated is not self._data:
+            return
+        # the positions moved, keep the entities of the remaining documents
+        entities = dict((id(entity._values), entity)
+                        for entity in self._entities.itervalues())
+        self._entities = dict((index, entities[id(document)])
+                              for index, document in enumerate(self._data)
+                              if id(document) in entities)
+
+    def _get_default_fields(self):
+        return self.__class__._fields or self.__class__._entity._fields
+
     def response_dict(self):
         response = []
         for item in self:
             response.append(item.response_dict())
         return response
 
+    def populate(self, callback, *names, **kwargs):
+        """Resolves the references of every entity with a single `$in`
+        query per referenced model, then `callback(collection, error)`; see
+        `Entity.populate`."""
+        loader = kwargs.get('loader') or ReferenceLoader()
+        populate(self, names, loader,
+                 lambda error: callback(collection=self, error=error))
+
     @classmethod
-    def find(cls, callback, **kwargs):
+    def find(cls, callback, fields=None, **kwargs):
         entity = cls()
-        entity.load(attributes=kwargs, callback=callback)
+        entity.load(attributes=kwargs, callback=callback, fields=fields)
+
+    @classmethod
+    def find_batches(cls, callback, batch_size=100, fields=None, **kwargs):
+        """Like `find` but streams the result: `callback(batch, error, next)`
+        gets an `Entities` instance per batch, see `Collection.load_batches`.
+        """
+        entities = cls()
+        entities.load_batches(attributes=kwargs, callback=callback,
+                              batch_size=batch_size, fields=fields)
+
+    @classmethod
+    def find_page(cls, callback, size=20, sort='_id', direction=1,
+                  token=None, fields=None, **kwargs):
+        """Keyset paginated `find`: `callback(collection, token, error)`,
+        see `Collection.page`."""
+        entities = cls()
+        entities.page(attributes=kwargs, callback=callback, size=size,
+                      sort=sort, direction=direction, token=token,
+                      fields=fields)
 
+
+class EntitiesView(object):
+    """Lazy slice of an `Entities` instance, entities are hydrated (and
+    memoized) by the parent on access."""
+
+    def __init__(self, entities, start, stop, step):
+        self._entities = entities
+        self._start = start
+        self._step = step
+        self._length = len(xrange(start, stop, step))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            return EntitiesView(self._entities,
+                                self._start + start * self._step,
+                                self._start + stop * self._step,
+                                step * self._step)
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self._entities[self._start + index * self._step]
+
+    def __len__(self):
+        return self._length
+
+    def response_dict(self):
+        return [item.response_dict() for item in self]
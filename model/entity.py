@@ -17,27 +17,94 @@
 # You should have received a copy of the GNU General Public License
 # along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
 
+from copy import deepcopy
+import logging
+
 from bson import ObjectId
 from tornado.escape import json_encode
 
-from eyestorm.objects import Persistable
+from eyestorm.utils import get_path
+from eyestorm.metrics import send_command
+from eyestorm.objects import Db, Persistable, WriteBatch, QueryCache, \
+                             apply_projection, cache_namespace
 
-from exceptions import InvalidAttribute, UnknownAttribute, MissingAttribute
+from exceptions import UnknownAttribute, MissingAttribute, PartialEntity
 
-from attributes import PrimaryKey, Reference, ReferenceOneToMany
+from attributes import ReferenceOneToMany
+from references import ReferenceLoader, populate
 
 from pprint import pprint
 
 
+class Field(object):
+    """Generated for every declared attribute, reads straight from the
+    entity `_values` (writes go through `Entity.__setattr__`)."""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, entity, owner):
+        if entity is None:
+            return self
+        return entity._touch(self.name)
+
+
+class EntityMeta(type):
+    """Builds the per-model machinery once, when the class is created:
+
+    - `__slots__` for the `_private_attributes` (so entities carry no
+      `__dict__`); a `_collection` declared in the class body is kept as
+      `_default_collection`, since the slot holds the asyncmongo collection.
+    - `_schema`: the model `_attributes` compiled into one validate-and-cast
+      function per field, instead of walking the `Attribute.validate` chain
+      and the references registry on every write.
+    - A `Field` descriptor per declared attribute.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        if '_collection' in attrs:
+            attrs['_default_collection'] = attrs.pop('_collection')
+        if '__slots__' not in attrs:
+            inherited = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited.update(klass.__dict__.get('__slots__', ()))
+            attrs['__slots__'] = tuple(
+                field for field in attrs.get('_private_attributes', ())
+                if field not in inherited)
+        return super(EntityMeta, mcs).__new__(mcs, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        super(EntityMeta, cls).__init__(name, bases, attrs)
+        cls._private_names = frozenset(cls._private_attributes)
+        cls._schema = dict((field, spec.compile(field))
+                           for field, spec in cls._attributes.iteritems())
+        for field in cls._attributes:
+            if not hasattr(cls, field):
+                setattr(cls, field, Field(field))
+
+
 class Entity(Persistable):
 
+    __metaclass__ = EntityMeta
+
     _collection = None
     _private_attributes = ['_db', '_values', '_callback', '_collection',
                            '_collection_name', '_error', '_exists', '_deleted',
+                           '_dirty', '_snapshot', '_populated', '_projection',
                            'operate']
 
     _accepts_unknown_attributes = True
     _attributes = {}
+    # queue inserts/updates in the WriteBatch, see eyestorm.objects
+    _batch_writes = False
+    # cache the queries results, see eyestorm.objects.QueryCache
+    _query_cache = None
+    # default projection of load/find (list of field names), see
+    # eyestorm.objects.apply_projection
+    _fields = None
 
     def __init__(self):
         super(Entity, self).__init__()
@@ -49,25 +116,29 @@ class Entity(Persistable):
         self._error = None
         self._exists = False
         self._deleted = {}
-        if self.__class__._collection:
-            self._set_collection(self.__class__._collection)
+        self._dirty = set()
+        self._snapshot = {}
+        self._populated = {}
+        self._projection = None
+        if self.__class__._default_collection:
+            self._set_collection(self.__class__._default_collection)
 
     def __getattr__(self, name):
-        if name in self.__class__._private_attributes:
-            return self.__dict__[name]
-        elif name in self._values:
-            return self._values[name]
-        return None
+        # only reached for undeclared attributes (or unset slots)
+        if name in self.__class__._private_names:
+            raise AttributeError(name)
+        return self._touch(name)
 
     def __setattr__(self, name, value):
-        if name in self.__class__._private_attributes:
-            self.__dict__[name] = value
+        if name in self.__class__._private_names:
+            object.__setattr__(self, name, value)
         else:
             self.__set_attribute(name, value)
 
     def __delattr__(self, name):
         if name in self._values:
             self._deleted[name] = 1
+            self._dirty.discard(name)
             del self._values[name]
 
     def __eq__(self, comparison):
@@ -79,29 +150,106 @@ class Entity(Persistable):
         return not self.__eq__(comparison)
 
     def __set_attribute(self, name, value):
-        if name in self.__class__._attributes:
-            spec = self.__class__._attributes[name]
-            if spec.validate(value):
-                if isinstance(spec, Reference) \
-                        and isinstance(spec.reference, PrimaryKey):
-                    self._values[name] = str(value)
-                else:
-                    self._values[name] = spec.cast(value)
-            else:
-                raise InvalidAttribute(name, value)
+        schema = self.__class__._schema
+        if name in schema:
+            self._values[name] = schema[name](value)
         elif self.__class__._accepts_unknown_attributes:
             self._values[name] = value
         else:
             raise UnknownAttribute(name)
+        self._dirty.add(name)
+        self._deleted.pop(name, None)
+
+    def __cast_attributes(self, attributes):
+        """Validates and casts a whole dict, nothing is stored unless every
+        value is valid."""
+        schema = self.__class__._schema
+        accepts_unknown = self.__class__._accepts_unknown_attributes
+        values = {}
+        for name, value in attributes.iteritems():
+            if name in schema:
+                values[name] = schema[name](value)
+            elif accepts_unknown:
+                values[name] = value
+            else:
+                raise UnknownAttribute(name)
+        return values
 
     def __check_values(self):
+        if self._projection is not None:
+            # the missing fields may well be stored, they weren't fetched
+            return
         for name, attribute in self.__class__._attributes.iteritems():
             if attribute.required and not name in self._values:
                 raise MissingAttribute(self.__class__, name)
 
+    # dirty tracking
+    def _touch(self, name):
+        """Reads `name`; lists and dicts are snapshotted on their first read
+        so changes made to them in place are noticed too (the fields never
+        read cost nothing)."""
+        value = self._values.get(name)
+        if isinstance(value, (list, dict)) and name not in self._snapshot:
+            self._snapshot[name] = deepcopy(value)
+        return value
+
+    def _mark_clean(self):
+        """Called whenever `_values` is replaced by the stored document."""
+        self._dirty = set()
+        self._deleted = {}
+        self._snapshot = {}
+
+    def _sending(self, changes, deleted):
+        """Marks `changes` (and the `deleted` names) as written as the write
+        is sent, so the fields set while it is in flight stay dirty. Returns
+        the function marking them dirty again if the write fails."""
+        self._dirty.difference_update(changes)
+        for name in deleted:
+            self._deleted.pop(name, None)
+        for name in changes:
+            if name in self._snapshot:
+                self._snapshot[name] = deepcopy(self._values[name])
+
+        def _failed():
+            self._dirty.update(name for name in changes
+                               if name in self._values)
+            for name in deleted:
+                if name not in self._values:
+                    self._deleted[name] = 1
+        return _failed
+
+    def mark_dirty(self, *names):
+        """Flags fields changed behind the entity back (e.g. in place
+        through `get_attributes()`) so the next update sends them."""
+        self._dirty.update(names)
+
+    def get_changes(self):
+        """Names of the fields changed since the entity was loaded or
+        saved."""
+        changes = set(self._dirty)
+        for name, value in self._snapshot.iteritems():
+            if name in self._values and self._values[name] != value:
+                changes.add(name)
+        changes.discard('_id')
+        return changes
+
+    def is_dirty(self):
+        return bool(self._deleted or self.get_changes())
+
     def validate_reference(self, value):
         return True
 
+    def _get_spec(self):
+        """Spec matching this entity, with its shard key for sharded models
+        so the operations reach its shard only."""
+        spec = {'_id': self._values['_id']}
+        shard_key = self.__class__._shard_key
+        if shard_key and shard_key != '_id':
+            value = get_path(self._values, shard_key)
+            if value is not None:
+                spec[shard_key] = value
+        return spec
+
     def _return(self):
         if callable(self._callback):
             self._callback(entity=self, error=self._error)
@@ -118,31 +266,56 @@ class Entity(Persistable):
 
     # attributes management
     def set_attributes(self, attributes, exists=False, force=False):
+        self._exists = exists
+        self._projection = None
         if force:
             self._values = attributes
         else:
-            self._exists = exists
-            self._values = {}
-            for name, value in attributes.iteritems():
-                self.__set_attribute(name, value)
+            self._values = self.__cast_attributes(attributes)
+        if exists:
+            self._mark_clean()
+        else:
+            self._dirty = set(self._values)
 
     def update_attributes(self, attributes, force=False):
-        if force:
-            self._values.update(attributes)
-        else:
-            for name, value in attributes.iteritems():
-                self.__set_attribute(name, value)
+        if not force:
+            attributes = self.__cast_attributes(attributes)
+        self._values.update(attributes)
+        self._dirty.update(attributes)
+        for name in attributes:
+            self._deleted.pop(name, None)
 
     def get_attributes(self):
         return self._values
 
+    # references
+    def populate(self, callback, *names, **kwargs):
+        """Loads the referenced entities (all references, or just `names`),
+        then `callback(entity, error)`; see `get_populated`. A `loader`
+        (`ReferenceLoader`) can be given to share what it already loaded.
+        """
+        loader = kwargs.get('loader') or ReferenceLoader()
+        populate([self], names, loader,
+                 lambda error: callback(entity=self, error=error))
+
+    def get_populated(self, name):
+        """The entity (or list of entities for `has_many`) referenced by the
+        `name` attribute, once populated."""
+        return self._populated.get(name)
+
     # validation
     def exists(self):
         return (self._exists and '_id' in self._values)
 
+    def is_partial(self):
+        """True when the entity was loaded with a projection, it then only
+        `$set`s its fields and refuses to overwrite the whole document."""
+        return self._projection is not None
+
     # reading
     def load(self, _id=None, attributes=None, callback=None, **kwargs):
         self._callback = callback
+        self._projection = apply_projection(kwargs, self.__class__._fields)
         if _id:
             self._id = ObjectId(_id)
             self.operate.set_criteria(self._id)
@@ -159,7 +332,8 @@ class Entity(Persistable):
         if result:
             self._values = result
             self._exists = True
-            self.operate.set_criteria(self._id)
+            self._mark_clean()
+            self.operate.set_criteria(self._get_spec())
         else:
             self._error = error
         self._return()
@@ -173,37 +347,74 @@ class Entity(Persistable):
             self._insert()
 
     def _insert(self):
+        if self.is_partial():
+            raise PartialEntity(self.__class__)
         if not '_id' in self._values or not self._values['_id']:
             self.__set_attribute('_id', ObjectId())
         self.__check_values()
-        self._collection.insert(self._values, callback=self._on_insert)
+        failed = self._sending(set(self._values), dict(self._deleted))
+
+        def _callback(result, error):
+            if error:
+                failed()
+            self._on_insert(result, error)
+        try:
+            if self.__class__._batch_writes:
+                WriteBatch().insert(self._collection_name, self._values,
+                                    _callback,
+                                    pool=self.get_pool(self._values))
+            else:
+                self._collection.insert(self._values, callback=_callback)
+        except Exception:
+            # not sent at all (e.g. TooManyConnections)
+            failed()
+            raise
 
     def _on_insert(self, result, error):
         if result:
             self._exists = True
-
-            def referenced(entity, error):
-                print "referenced! =D"
-                pprint(entity)
-
-            for name, attribute in self.__class__._attributes.iteritems():
-                if isinstance(attribute, ReferenceOneToMany):
-
-                    def _append_to_stack(entity, error, stack=attribute.stack):
-                        getattr(entity, stack).append(str(self._id))
-                        entity.update(referenced)
-
-                    attribute.model.find(_id=getattr(self, name),
-                                         callback=_append_to_stack)
-
-
+            self._update_stacks('addToSet')
         self._error = error
         self._return()
 
+    def _update_stacks(self, operator):
+        """Adds (`addToSet`) or removes (`pull`) this entity id from the
+        stacks of the entities referenced through `as_in`, one atomic
+        update each."""
+        def _callback(result, error):
+            if error:
+                logging.error("Couldn't %s %s to a stack: %s", operator,
+                              self._id, error)
+
+        for name, attribute in self.__class__._attributes.iteritems():
+            if isinstance(attribute, ReferenceOneToMany):
+                value = self._values.get(name)
+                if value is None:
+                    continue
+                entity = attribute.model()
+                entity.operate.set_criteria(ObjectId(value))
+                getattr(entity.operate, operator)(attribute.stack,
+                                                  str(self._id),
+                                                  callback=_callback)
+
     def _update(self):
+        if self.exists():
+            self.update(self._on_update)
+            return
+        if self.is_partial():
+            raise PartialEntity(self.__class__)
         self.__check_values()
-        self._collection.update({'_id': self._values['_id']},
-                                self._values, callback=self._on_update)
+        failed = self._sending(set(self._values), dict(self._deleted))
+
+        def _callback(result, error):
+            if error:
+                failed()
+            self._on_update(result, error)
+        try:
+            self._send_update(self._get_spec(), self._values, _callback)
+        except Exception:
+            failed()
+            raise
 
     def _on_update(self, result, error):
         if result:
@@ -212,19 +423,43 @@ class Entity(Persistable):
         self._return()
 
     def update(self, callback):
+        """Sends only the fields changed since load/save (`$set`/`$unset`),
+        nothing at all when the entity is not dirty, in which case
+        `callback` gets (None, None)."""
         self.__check_values()
         if self.exists():
-            document = self._values.copy()
-            del document['_id']
-            operations = {'$set': document}
-            if self._deleted:
-                operations['$unset'] = self._deleted
-            self._collection.update({'_id': self._values['_id']},
-                                    operations,
-                                    callback=callback)
+            changes = self.get_changes()
+            deleted = dict(self._deleted)
+            if not changes and not deleted:
+                callback(None, None)
+                return
+            operations = {}
+            if changes:
+                operations['$set'] = dict((name, self._values[name])
+                                          for name in changes)
+            if deleted:
+                operations['$unset'] = deleted
+            failed = self._sending(changes, deleted)
+
+            def _callback(result, error):
+                if error:
+                    failed()
+                callback(result, error)
+            try:
+                self._send_update(self._get_spec(), operations, _callback)
+            except Exception:
+                failed()
+                raise
         else:
             self.save(callback)
 
+    def _send_update(self, spec, document, callback):
+        if self.__class__._batch_writes:
+            WriteBatch().update(self._collection_name, spec, document,
+                                callback, pool=self.get_pool(self._values))
+        else:
+            self._collection.update(spec, document, callback=callback)
+
     # deleting
     def delete(self, _id=None, criteria=None, callback=None):
         self._callback = callback
@@ -233,8 +468,11 @@ class Entity(Persistable):
         elif criteria:
             self._collection.remove(criteria, callback=self._on_delete)
         elif self.exists():
-            self._collection.remove(self._values['_id'],
-                                    callback=self._on_delete)
+            def _callback(result, error):
+                if not error:
+                    self._update_stacks('pull')
+                self._on_delete(result, error)
+            self._collection.remove(self._get_spec(), callback=_callback)
         else:
             return False
 
@@ -251,19 +489,53 @@ class Entity(Persistable):
         entity.save(callback)
 
     @classmethod
-    def fast_update(cls, _id, callback, **kwargs):
-        def _callback(entity, error):
-            if entity.exists():
-                entity.update_attributes(kwargs)
-                entity.update(callback)
-            else:
-                callback(entity, error)
+    def fast_update(cls, _id, callback, upsert=False, return_document=False,
+                    **kwargs):
+        """Updates the `kwargs` fields of the `_id` entity in a single round
+        trip: only `kwargs` are validated and `$set`, nothing is read first.
+
+        `callback(entity, error)` gets a partial entity holding just `_id`
+        and `kwargs`, or the whole updated document when `return_document` is
+        set (findAndModify). `upsert` creates the document if missing.
+        """
         entity = cls()
-        entity.load(_id=_id, callback=_callback)
-
-
+        entity.update_attributes(kwargs)
+        _id = ObjectId(_id)
+        values = dict((name, entity._values[name]) for name in kwargs)
+        criteria = {'_id': _id}
+        operations = {'$set': values}
+
+        def _on_update(result, error):
+            if not error:
+                last_error = result[0] if result else {}
+                entity.set_attributes(dict(values, _id=_id),
+                                      bool(last_error.get('n')), True)
+                entity._projection = values.keys()
+                entity.operate.set_criteria(_id)
+            callback(entity=entity, error=error)
+
+        def _on_find_and_modify(result, error):
+            QueryCache().invalidate(namespace)
+            if not error and not (result and result.get('ok')):
+                error = (result or {}).get('errmsg', "findAndModify failed")
+            if not error and result.get('value'):
+                entity.set_attributes(result['value'], True, True)
+                entity.operate.set_criteria(_id)
+            callback(entity=entity, error=error)
+
+        if return_document:
+            pool = entity.get_pool(criteria)
+            namespace = cache_namespace(pool, entity._collection_name)
+            QueryCache().invalidate(namespace)
+            send_command(Db().get_connection(pool), 'findAndModify',
+                         entity._collection_name, query=criteria,
+                         update=operations, new=True, upsert=upsert,
+                         callback=_on_find_and_modify)
+        else:
+            entity._collection.update(criteria, operations, upsert=upsert,
+                                      callback=_on_update)
 
     @classmethod
-    def find(cls, callback, **kwargs):
+    def find(cls, callback, fields=None, **kwargs):
         entity = cls()
-        entity.load(callback=callback, attributes=kwargs)
+        entity.load(callback=callback, attributes=kwargs, fields=fields)
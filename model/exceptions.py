@@ -45,3 +45,13 @@ class MissingAttribute(Exception):
 
     def __str__(self):
         return "Missing attribute '%s' for %s model" % (self.name, self.model)
+
+
+class PartialEntity(Exception):
+
+    def __init__(self, model):
+        self.model = repr(model)
+
+    def __str__(self):
+        return "Can't overwrite the whole document of a partial %s " \
+               "entity" % self.model
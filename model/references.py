@@ -0,0 +1,130 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from attributes import Reference, ReferenceManyToOne
+
+
+def _key(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+def _query_value(attribute, value):
+    if attribute.attribute == '_id' and not isinstance(value, ObjectId):
+        try:
+            return ObjectId(value)
+        except (InvalidId, TypeError):
+            pass
+    return value
+
+
+class ReferenceLoader(object):
+    """Loads referenced entities in batches: every value asked for a given
+    model attribute goes in a single `$in` query, and what was loaded once is
+    not loaded again. Meant to live as long as a request does (see
+    `eyestorm.web.BaseHandler.get_reference_loader`).
+    """
+
+    def __init__(self):
+        self._loaded = {}
+
+    def load(self, attribute, values, callback):
+        """Calls `callback(entities, error)`, `entities` being a dict of the
+        referenced entities by (stringified) value."""
+        loaded = self._loaded.setdefault((attribute.model_name,
+                                          attribute.attribute), {})
+        missing = set(_key(value) for value in values) - set(loaded)
+        if not missing:
+            callback(loaded, None)
+            return
+        model = attribute.model
+        handle = model()
+
+        def _callback(result, error):
+            if not error:
+                for document in result:
+                    entity = model()
+                    entity._set_collection(handle._collection_name,
+                                           handle._collection)
+                    entity.set_attributes(document, True, True)
+                    if '_id' in document:
+                        entity.operate.set_criteria(document['_id'])
+                    loaded[_key(document.get(attribute.attribute))] = entity
+            callback(loaded, error)
+        criteria = {attribute.attribute: {
+            '$in': [_query_value(attribute, value) for value in missing]}}
+        handle._collection.find(criteria, callback=_callback)
+
+
+def populate(entities, names, loader, callback):
+    """Resolves the references `names` (all of them when empty) of every
+    entity in `entities` with one query per referenced model; the results
+    are available through `Entity.get_populated`. `callback(error)`.
+    """
+    if not len(entities):
+        callback(None)
+        return
+    attributes = entities[0].__class__._attributes
+    references = [(name, attribute)
+                  for name, attribute in attributes.iteritems()
+                  if isinstance(attribute, Reference)
+                  and (not names or name in names)]
+    if not references:
+        callback(None)
+        return
+    # references to the same model attribute share a single query
+    groups = {}
+    for name, attribute in references:
+        groups.setdefault((attribute.model_name, attribute.attribute),
+                          []).append((name, attribute))
+    state = {'pending': len(groups), 'error': None}
+
+    def _resolve(group, loaded, error):
+        for name, attribute in group:
+            many = isinstance(attribute, ReferenceManyToOne)
+            for entity in entities:
+                value = entity.get_attributes().get(name)
+                if many:
+                    populated = [loaded[_key(item)] for item in value or []
+                                 if _key(item) in loaded]
+                else:
+                    populated = loaded.get(_key(value))
+                entity._populated[name] = populated
+        state['error'] = state['error'] or error
+        state['pending'] -= 1
+        if not state['pending']:
+            callback(state['error'])
+
+    for group in groups.itervalues():
+        values = []
+        for name, attribute in group:
+            for entity in entities:
+                value = entity.get_attributes().get(name)
+                if isinstance(attribute, ReferenceManyToOne):
+                    values.extend(value or [])
+                elif value is not None:
+                    values.append(value)
+
+        def _callback(loaded, error, group=group):
+            _resolve(group, loaded, error)
+        loader.load(group[0][1], values, _callback)
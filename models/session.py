@@ -26,9 +26,20 @@ from eyestorm.model import Entity, Attribute
 class Session(Entity):
 
     _collection = options.sessions_store_collection
+    # Session and Sessions get `_shards`/`_shard_key` from sessions_shards
+    # in MongoSessionBackend.setup (options aren't parsed yet on import)
+    _shards = None
+    _shard_key = None
 
     fruta = Attribute()
 
+    def is_empty(self):
+        """True when nothing but the bookkeeping fields is stored."""
+        for name in self._values:
+            if name not in ('_id', '__expires'):
+                return False
+        return True
+
 
 class Sessions(Collection):
 
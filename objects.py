@@ -17,49 +17,345 @@
 # You should have received a copy of the GNU General Public License
 # along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
 
-from bson import ObjectId
+from copy import deepcopy
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from bson import ObjectId, BSON
+from bson.errors import InvalidBSON
 import logging
 
 import tornado
+import tornado.ioloop
 import asyncmongo
 
 from eyestorm import options
+from eyestorm.utils import singleton, LRUCache, get_path
+from eyestorm.indexes import Indexes
+from eyestorm.sharding import ShardedCollectionHandle
+from eyestorm.metrics import MongoMetrics, send, send_command
 
 
 # Dev purposes (will be removed)
 from pprint import pprint
 
 
-def singleton(cls):
-    instances = {}
-
-    def getinstance():
-        if cls not in instances:
-            instances[cls] = cls()
-        return instances[cls]
-    return getinstance
-
-
 @singleton
 class Db(object):
-    """System-wide (singleton) asyncmongo client instance"""
+    """System-wide (singleton) asyncmongo client instances, one per pool:
+    the 'default' one (`options.db`) and the named ones of
+    `options.db_pools`, created on first use."""
 
     def __init__(self):
         self._config = options.db
         self._connection = asyncmongo.Client(**self._config)
+        self._connections = {}
+        MongoMetrics().watch_pool('default', self._connection)
         logging.info("Mongo connection created")
 
-    def get_config(self):
-        return self._config
+    def get_config(self, pool=None):
+        if not pool or pool == 'default':
+            return self._config
+        config = dict(self._config)
+        config['pool_id'] = "%s.%s" % (self._config.get('pool_id'), pool)
+        config.update(options.db_pools[pool])
+        return config
+
+    def get_connection(self, pool=None):
+        if not pool or pool == 'default':
+            return self._connection
+        if pool not in self._connections:
+            self._connections[pool] = asyncmongo.Client(
+                                                **self.get_config(pool))
+            MongoMetrics().watch_pool(pool, self._connections[pool])
+            logging.info("Mongo connection created for the '%s' pool", pool)
+        return self._connections[pool]
+
+    def get_pools(self):
+        return ['default'] + sorted(options.db_pools)
+
+
+def _normalize(value):
+    """Hashable (and key order independent) version of a query value."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _normalize(item))
+                            for key, item in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(item) for item in value)
+    return value
+
+
+def apply_projection(kwargs, default=None):
+    """Sets the `fields` of find/find_one `kwargs` to the `default`
+    projection when none is given; `fields=False` asks for whole documents.
+    Returns the projection that will be used (None for whole documents).
+    """
+    fields = kwargs.pop('fields', None)
+    if fields is None:
+        fields = default
+    if not fields:
+        return None
+    kwargs['fields'] = fields
+    return fields
+
+
+def cache_namespace(pool, collection):
+    """`QueryCache` name of `collection` in the database of `pool`, pools
+    may hold same-named collections of different databases (or shards)."""
+    return "%s:%s" % (pool or 'default', collection)
+
+
+@singleton
+class QueryCache(object):
+    """Process-wide (singleton) cache of query results, per collection.
+
+    Only the collections of the models declaring `_query_cache` (a dict of
+    `max_entries`, `max_bytes` and `ttl` seconds) are cached. Any write
+    issued through a `CollectionHandle`, the `WriteBatch` or `BulkInsert`
+    drops the cached results of its collection. Collections are named by
+    `cache_namespace`.
+    """
+
+    def __init__(self):
+        self._caches = {}
+        self._generations = {}
+
+    def configure(self, collection, max_entries=1000,
+                  max_bytes=8 * 1024 * 1024, ttl=60):
+        if not collection in self._caches:
+            self._caches[collection] = LRUCache(max_entries, ttl, max_bytes)
+            self._generations[collection] = 0
+
+    def is_enabled(self, collection):
+        return collection in self._caches
+
+    def generation(self, collection):
+        return self._generations.get(collection)
+
+    def get(self, collection, key):
+        """Returns a copy of the cached result (or None)."""
+        result = self._caches[collection].get(key)
+        return deepcopy(result) if result is not None else None
+
+    def set(self, collection, key, result, generation):
+        """Caches `result` unless the collection was written since
+        `generation` was read (the query started)."""
+        if self._generations.get(collection) != generation:
+            return
+        documents = result if isinstance(result, list) else [result]
+        size = sum(len(BSON.encode(document)) for document in documents)
+        self._caches[collection].set(key, deepcopy(result), size=size)
+
+    def invalidate(self, collection):
+        if collection in self._caches:
+            self._generations[collection] += 1
+            self._caches[collection].clear()
+
+    def stats(self):
+        return dict((collection, cache.stats())
+                    for collection, cache in self._caches.iteritems())
+
+
+class CollectionHandle(object):
+    """Wraps an asyncmongo collection: reads go through the `QueryCache`
+    (when enabled for the collection) and writes invalidate it.
+
+    Reads are sent to `read_collection` when given (a collection of another
+    pool, see `Persistable._read_pool`) and a `read_pool` keyword picks the
+    pool of a single find/find_one.
+    """
+
+    def __init__(self, name, collection, read_collection=None, pool=None,
+                 read_pool=None):
+        self._name = name
+        self._handle = collection
+        self._read_handle = read_collection or collection
+        self._namespace = cache_namespace(pool, name)
+        self._read_pool = read_pool if read_collection else pool
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+    def _read(self, method, pool, args, kwargs):
+        cache = QueryCache()
+        callback = kwargs.pop('callback')
+        if not cache.is_enabled(self._namespace):
+            send(method, self._name, method.__name__, *args,
+                 callback=callback, **kwargs)
+            return
+        key = (pool, method.__name__, _normalize(args), _normalize(kwargs))
+        result = cache.get(self._namespace, key)
+        if result is not None:
+            callback(result, None)
+            return
+        generation = cache.generation(self._namespace)
+
+        def _callback(result, error):
+            if not error and result is not None:
+                cache.set(self._namespace, key, result, generation)
+            callback(result, error)
+        send(method, self._name, method.__name__, *args, callback=_callback,
+             **kwargs)
+
+    def _write(self, method, args, kwargs):
+        cache = QueryCache()
+        callback = kwargs.get('callback')
+        cache.invalidate(self._namespace)
+        if callable(callback):
+            def _callback(*args, **kwargs):
+                cache.invalidate(self._namespace)
+                callback(*args, **kwargs)
+            kwargs['callback'] = _callback
+        send(method, self._name, method.__name__, *args, **kwargs)
+
+    def _get_reader(self, kwargs):
+        pool = kwargs.pop('read_pool', None)
+        if pool is None:
+            return self._read_pool, self._read_handle
+        return pool, getattr(Db().get_connection(pool), self._name)
+
+    def find(self, *args, **kwargs):
+        pool, reader = self._get_reader(kwargs)
+        self._read(reader.find, pool, args, kwargs)
+
+    def find_one(self, *args, **kwargs):
+        pool, reader = self._get_reader(kwargs)
+        self._read(reader.find_one, pool, args, kwargs)
 
-    def get_connection(self):
-        return self._connection
+    def insert(self, *args, **kwargs):
+        self._write(self._handle.insert, args, kwargs)
+
+    def update(self, *args, **kwargs):
+        self._write(self._handle.update, args, kwargs)
+
+    def remove(self, *args, **kwargs):
+        self._write(self._handle.remove, args, kwargs)
+
+
+def _merge_each(field, current, value):
+    """Merges two `push`/`addToSet` values of `field` into one `$each`,
+    keeping the modifiers ($slice, $sort...) unless they disagree."""
+    merged = {}
+    items = []
+    for item in (current, value):
+        if isinstance(item, dict) and '$each' in item:
+            for modifier, argument in item.iteritems():
+                if modifier == '$each':
+                    continue
+                if merged.get(modifier, argument) != argument:
+                    raise ValueError("conflicting %s modifiers on '%s'"
+                                     % (modifier, field))
+                merged[modifier] = argument
+            items.extend(item['$each'])
+        else:
+            items.append(item)
+    merged['$each'] = items
+    return merged
+
+
+class MongoOperations(object):
+    """Collects atomic operators over several fields and sends them as a
+    single update against the criteria of the `MongoHelper` it comes from:
+
+        operations = entity.operate.batch()
+        operations.inc('visits', 1).set('seen', now).push('log', entry)
+        operations.send(callback)
+
+    Repeated operators on the same field are merged (`inc` adds up, `push`
+    and `addToSet` use `$each`, `pull`s of plain values and `pullAll`s
+    become a single `$pullAll`); different operators on the same field raise
+    ValueError.
+    """
+
+    def __init__(self, collection, criteria):
+        self._collection = collection
+        self._criteria = criteria
+        self._document = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def operator(field, value=None):
+            self._add(name, field, value)
+            return self
+        return operator
+
+    def _add(self, name, field, value):
+        operator = "$%s" % name
+        if name in ('pull', 'pullAll'):
+            self._add_pull(operator, field, value)
+            return
+        self._check_conflicts(operator, field)
+        fields = self._document.setdefault(operator, {})
+        if not field in fields:
+            fields[field] = value
+        elif name == 'inc':
+            fields[field] += value
+        elif name in ('push', 'addToSet'):
+            fields[field] = _merge_each(field, fields[field], value)
+        else:
+            fields[field] = value
+
+    def _add_pull(self, operator, field, value):
+        """`pull`s and `pullAll`s of the same field end up in a single
+        `$pullAll`; `pull` conditions ({'$in': ...}, {'$gt': 3}...) can't be
+        merged, `$pullAll` only takes values."""
+        pulls = self._document.get("$pull", {})
+        pulled = self._document.get("$pullAll", {})
+        if field not in pulls and field not in pulled:
+            self._check_conflicts(operator, field)
+            if operator == "$pullAll":
+                value = list(value)
+            self._document.setdefault(operator, {})[field] = value
+            return
+        if operator == "$pull" and isinstance(value, dict) \
+                or isinstance(pulls.get(field), dict):
+            raise ValueError("can't merge the $pull conditions on '%s'"
+                             % field)
+        values = list(value) if operator == "$pullAll" else [value]
+        if field in pulls:
+            values.insert(0, pulls.pop(field))
+            if not pulls:
+                del self._document["$pull"]
+        self._document.setdefault("$pullAll", {}).setdefault(field, []) \
+                                                              .extend(values)
+
+    def _check_conflicts(self, operator, field):
+        """Mongo rejects updates touching a field (or a path inside it)
+        with more than one operator, raises ValueError before sending."""
+        for other_operator, fields in self._document.iteritems():
+            for other in fields:
+                if other == field and other_operator == operator:
+                    continue
+                if other == field or other.startswith(field + '.') \
+                        or field.startswith(other + '.'):
+                    raise ValueError("%s on '%s' conflicts with %s on '%s'"
+                                     % (operator, field, other_operator,
+                                        other))
+
+    def get_document(self):
+        return self._document
+
+    def send(self, callback=None, multi=False):
+        """Sends every collected operator in one update, `callback(result,
+        error)`; with `multi` every document matching the criteria is
+        updated."""
+        callback = callback or (lambda result, error: None)
+        if not self._document:
+            callback(None, None)
+            return
+        self._collection.update(self._criteria, self._document, multi=multi,
+                                callback=callback)
 
 
 class MongoHelper():
 
     def __init__(self, collection):
         self._collection = collection
+        self._criteria = None
+
+    def batch(self):
+        """Returns a `MongoOperations` builder for the current criteria."""
+        return MongoOperations(self._collection, self._criteria)
 
     def set_criteria(self, criteria):
         if isinstance(criteria, ObjectId):
@@ -75,6 +371,344 @@ class MongoHelper():
         return method
 
 
+@singleton
+class WriteBatch(object):
+    """Process-wide (singleton) unit of work for writes.
+
+    Inserts and updates queued during one IOLoop iteration are sent on the
+    next one as a single `insert` command (unordered) and a single ordered
+    `update` command per collection, then every queued callback gets its own
+    `(result, error)`, shaped like asyncmongo's (`[{'ok': 1, ...}]`).
+    Used by the models declaring `_batch_writes = True`.
+    """
+
+    # commands are bounded by operations and BSON bytes (mongo refuses
+    # commands over 16MB)
+    max_size = 1000
+    max_bytes = 8 * 1024 * 1024
+
+    def __init__(self):
+        self._pending = {}
+        self._scheduled = False
+
+    def _queue(self, pool, collection, operation, item):
+        key = (pool, collection)
+        if key not in self._pending:
+            self._pending[key] = {'insert': [], 'update': []}
+        self._pending[key][operation].append(item)
+        if not self._scheduled:
+            self._scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.flush)
+
+    def insert(self, collection, document, callback=None, pool=None):
+        self._queue(pool, collection, 'insert', (document, callback))
+
+    def update(self, collection, spec, document, callback=None, upsert=False,
+               multi=False, pool=None):
+        operation = {'q': spec, 'u': document, 'upsert': upsert,
+                     'multi': multi}
+        self._queue(pool, collection, 'update', (operation, callback))
+
+    def flush(self):
+        pending = self._pending
+        self._pending = {}
+        self._scheduled = False
+        for (pool, collection), operations in pending.iteritems():
+            for chunk in self._chunks(operations['insert']):
+                self._send(pool, 'insert', collection, chunk, 'documents',
+                           False)
+            for chunk in self._chunks(operations['update']):
+                self._send(pool, 'update', collection, chunk, 'updates',
+                           True)
+
+    def _chunks(self, items):
+        """Splits the queued `(item, callback)`s in chunks of at most
+        `max_size` items and `max_bytes` (a bigger item goes alone)."""
+        chunk = []
+        size = 0
+        for item in items:
+            try:
+                item_size = len(BSON.encode(item[0]))
+            except Exception:
+                # not encodable, sending its chunk reports the error
+                item_size = 0
+            if chunk and (len(chunk) >= self.max_size
+                          or size + item_size > self.max_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(item)
+            size += item_size
+        if chunk:
+            yield chunk
+
+    def _send(self, pool, command, collection, items, key, ordered):
+        namespace = cache_namespace(pool, collection)
+        QueryCache().invalidate(namespace)
+
+        def _callback(result, error):
+            QueryCache().invalidate(namespace)
+            if not error and not (result and result.get('ok')):
+                error = (result or {}).get('errmsg', "%s failed" % command)
+            errors = {}
+            if not error:
+                for write_error in result.get('writeErrors', []):
+                    errors[write_error['index']] = write_error['errmsg']
+            # ordered commands stop at the first failing item
+            stopped = min(errors) if ordered and errors else None
+            for index, (item, callback) in enumerate(items):
+                if not callable(callback):
+                    continue
+                if error or index in errors:
+                    callback(None, error or errors[index])
+                elif stopped is not None and index > stopped:
+                    callback(None, "not applied, a previous %s failed" \
+                                   % command)
+                else:
+                    callback([{'ok': 1.0, 'err': None}], None)
+        try:
+            send_command(Db().get_connection(pool), command, collection,
+                         callback=_callback, ordered=ordered,
+                         **{key: [item for item, c in items]})
+        except Exception as error:
+            # e.g. TooManyConnections, the chunks left are still sent
+            logging.error("%s on %s failed: %s", command, collection, error)
+            _callback(None, error)
+
+
+class BulkInsert(object):
+    """Inserts the documents of any iterable (generators included) in
+    batches bounded by `batch_size` documents and `max_bytes` of BSON.
+
+    Up to `concurrency` batches are in flight at a time; the iterable is only
+    consumed as batches are sent. Ordered inserts send one batch at a time
+    and stop at the first error, unordered ones carry on. When done
+    `callback(result, errors)` gets {'inserted': n, 'batches': n,
+    'documents': [...] (only if `keep`)} and a list of
+    (batch number, error) tuples.
+    """
+
+    def __init__(self, db, collection, documents, callback=None,
+                 batch_size=1000, max_bytes=8 * 1024 * 1024, concurrency=2,
+                 ordered=True, keep=False, pool=None):
+        self._db = db
+        self._collection = collection
+        self._namespace = cache_namespace(pool, collection)
+        self._documents = iter(documents)
+        self._carry = None
+        self._callback = callback
+        self._batch_size = batch_size
+        self._max_bytes = max_bytes
+        self._concurrency = 1 if ordered else max(concurrency, 1)
+        self._ordered = ordered
+        self._kept = [] if keep else None
+        self._in_flight = 0
+        self._batches = 0
+        self._inserted = 0
+        self._errors = []
+        self._exhausted = False
+        self._finished = False
+
+    def start(self):
+        self._pump()
+
+    def _next_batch(self):
+        batch = []
+        size = 0
+        while len(batch) < self._batch_size:
+            if self._carry is not None:
+                document, self._carry = self._carry, None
+            else:
+                try:
+                    document = next(self._documents)
+                except StopIteration:
+                    break
+            if not '_id' in document:
+                document['_id'] = ObjectId()
+            document_size = len(BSON.encode(document))
+            if batch and size + document_size > self._max_bytes:
+                self._carry = document
+                break
+            batch.append(document)
+            size += document_size
+        return batch
+
+    def _pump(self):
+        while self._in_flight < self._concurrency and not self._exhausted:
+            if self._ordered and self._errors:
+                self._exhausted = True
+                break
+            batch = self._next_batch()
+            if not batch:
+                self._exhausted = True
+                break
+            self._batches += 1
+            self._in_flight += 1
+            self._send(self._batches, batch)
+        if self._exhausted and not self._in_flight and not self._finished:
+            self._finished = True
+            if callable(self._callback):
+                result = {'inserted': self._inserted,
+                          'batches': self._batches}
+                if self._kept is not None:
+                    result['documents'] = self._kept
+                self._callback(result, self._errors)
+
+    def _send(self, number, batch):
+        QueryCache().invalidate(self._namespace)
+
+        def _callback(result, error):
+            QueryCache().invalidate(self._namespace)
+            self._in_flight -= 1
+            if not error and not (result and result.get('ok')):
+                error = (result or {}).get('errmsg', "insert failed")
+            if error:
+                self._errors.append((number, error))
+            else:
+                self._inserted += result.get('n', 0)
+                if result.get('writeErrors'):
+                    self._errors.append((number, result['writeErrors']))
+                if self._kept is not None:
+                    self._kept.extend(batch)
+            self._pump()
+        send_command(self._db, 'insert', self._collection, documents=batch,
+                     ordered=self._ordered, callback=_callback)
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def encode_token(key, value, _id):
+    """Opaque (url safe) continuation token of a keyset position."""
+    return urlsafe_b64encode(BSON.encode({'k': key, 'v': value, 'i': _id}))
+
+
+def decode_token(token, key):
+    """(value, _id) position encoded in `token`, which must have been made
+    for the `key` sort key; raises InvalidToken otherwise."""
+    try:
+        position = BSON(urlsafe_b64decode(str(token))).decode()
+    except (TypeError, ValueError, InvalidBSON):
+        raise InvalidToken(token)
+    if position.get('k') != key or not 'i' in position:
+        raise InvalidToken(token)
+    return position.get('v'), position['i']
+
+
+class BatchCursor(object):
+    """Walks the documents matching `criteria` in batches of `batch_size`.
+
+    Batches are fetched on demand: nothing is requested until `next` is
+    called and the following batch is not requested until `next` is called
+    again, so a slow consumer never has more than one batch in memory.
+
+    Without `sort`, or sorting by a single key, the cursor pages on key
+    ranges (keyset pagination, ties broken by `_id`) so every batch costs
+    the same however deep it is; the key should be indexed (together with
+    `_id`) and present in every document. Sorting by several keys falls
+    back to skip/limit. `get_token` returns an opaque token of the current
+    position, pass it as `token` to resume from there.
+
+    Works with tornado.gen as well:
+
+        batch, error = (yield gen.Task(cursor.next)).args
+
+    """
+
+    def __init__(self, collection, criteria=None, batch_size=100, wrap=None,
+                 token=None, **kwargs):
+        self._collection = collection
+        self._criteria = criteria or {}
+        self._batch_size = batch_size
+        self._wrap = wrap
+        self._skip = kwargs.pop('skip', 0)
+        self._limit = kwargs.pop('limit', 0)
+        self._kwargs = kwargs
+        self._key, self._direction = self._get_key(kwargs.get('sort'))
+        if self._key:
+            sort = [(self._key, self._direction)]
+            if self._key != '_id':
+                sort.append(('_id', self._direction))
+                fields = kwargs.get('fields')
+                if isinstance(fields, (list, tuple)) \
+                        and not self._key in fields:
+                    kwargs['fields'] = list(fields) + [self._key]
+            kwargs['sort'] = sort
+        self._last = None
+        if token and self._key:
+            self._last = decode_token(token, self._key)
+        self._fetched = 0
+        self.exhausted = False
+
+    def _get_key(self, sort):
+        if sort is None:
+            if '_id' in self._criteria \
+                    and not isinstance(self._criteria['_id'], dict):
+                return None, 1
+            return '_id', 1
+        if len(sort) == 1:
+            return sort[0]
+        return None, 1
+
+    def _get_spec(self):
+        if not self._key or self._last is None:
+            return self._criteria
+        value, _id = self._last
+        operator = '$gt' if self._direction > 0 else '$lt'
+        spec = self._criteria.copy()
+        if self._key == '_id':
+            condition = dict(spec.get('_id', {}))
+            condition[operator] = _id
+            spec['_id'] = condition
+            return spec
+        keyset = [{self._key: {operator: value}},
+                  {self._key: value, '_id': {operator: _id}}]
+        if '$or' in spec:
+            return {'$and': [spec, {'$or': keyset}]}
+        spec['$or'] = keyset
+        return spec
+
+    def get_token(self):
+        """Continuation token of the position after the last batch, None
+        when the cursor is exhausted (or doesn't page on a key)."""
+        if self.exhausted or not self._key or self._last is None:
+            return None
+        return encode_token(self._key, *self._last)
+
+    def next(self, callback):
+        """Fetches the next batch, `callback(batch, error)` gets an empty
+        batch once the cursor is exhausted."""
+        size = self._batch_size
+        if self._limit:
+            size = min(size, self._limit - self._fetched)
+        if self.exhausted or size <= 0:
+            self.exhausted = True
+            callback(self._wrap([]) if self._wrap else [], None)
+            return
+
+        def _on_batch(result, error):
+            result = result or []
+            if error or len(result) < size:
+                self.exhausted = True
+            if result:
+                self._fetched += len(result)
+                last = result[-1]
+                self._last = (get_path(last, self._key or '_id'),
+                              last.get('_id'))
+            if self._wrap:
+                result = self._wrap(result)
+            callback(result, error)
+
+        if self._key:
+            # the key range already starts after the skipped documents
+            skip = self._skip if self._last is None else 0
+        else:
+            skip = self._skip + self._fetched
+        self._collection.find(self._get_spec(), skip=skip, limit=size,
+                              callback=_on_batch, **self._kwargs)
+
+
 class Persistable(object):
     """`Abstract` class that represent a mongo collection object.
 
@@ -82,6 +716,17 @@ class Persistable(object):
 
     """
 
+    __slots__ = ('_db',)
+
+    # Db pool of the model (None for the default one) and the pool its reads
+    # go to (e.g. one set on a secondary with `slave_okay`), `_pool` if None
+    _pool = None
+    _read_pool = None
+    # hash sharding: documents are spread over the `_shards` pools (every
+    # pool if None) by their `_shard_key` value, see eyestorm.sharding
+    _shard_key = None
+    _shards = None
+
     def __init__(self):
         self._db = None
 
@@ -92,25 +737,114 @@ class Persistable(object):
 
     def _initialize_db(self):
         if self._db is None:
-            self._db = Db().get_connection()
+            self._db = Db().get_connection(self.__class__._pool)
 
-    def _set_collection(self, collection):
-        self._initialize_db()
+    def get_read_db(self, pool=None):
+        """Connection of the pool the reads go to: `pool` when given,
+        otherwise the one of the model, see `_read_pool`."""
+        pool = pool or self.__class__._read_pool
+        if pool is None:
+            return self.db
+        return Db().get_connection(pool)
+
+    def get_pool(self, document=None):
+        """Pool holding `document` (or the documents matching a spec): the
+        one of the model, or the shard `document` belongs to for sharded
+        models (ValueError when it can't be told)."""
+        if not self.__class__._shard_key:
+            return self.__class__._pool
+        return self._collection.get_pool(document or {})
+
+    def get_db(self, document=None):
+        """Connection of the pool holding `document`, see `get_pool`."""
+        if not self.__class__._shard_key:
+            return self.db
+        return Db().get_connection(self.get_pool(document))
+
+    def _new_sharded_handle(self, collection):
+        dbs = dict((pool, Db().get_connection(pool))
+                   for pool in self.__class__._shards or Db().get_pools())
+        handles = dict((pool, CollectionHandle(collection,
+                                               getattr(db, collection),
+                                               pool=pool))
+                       for pool, db in dbs.iteritems())
+        return ShardedCollectionHandle(collection, self.__class__._shard_key,
+                                       handles, dbs)
+
+    def _set_collection(self, collection, handle=None):
+        """`handle` allows to share an already created asyncmongo
+        collection instead of building a new one."""
         self._collection_name = collection
-        self._collection = getattr(self._db, collection)
+        if handle is None:
+            self._initialize_db()
+            read_collection = None
+            if self.__class__._read_pool:
+                read_collection = getattr(self.get_read_db(), collection)
+            if self.__class__._shard_key:
+                handle = self._new_sharded_handle(collection)
+            else:
+                handle = CollectionHandle(collection,
+                                          getattr(self._db, collection),
+                                          read_collection,
+                                          self.__class__._pool,
+                                          self.__class__._read_pool)
+            if getattr(self.__class__, '_query_cache', None):
+                pools = [self.__class__._pool]
+                if self.__class__._shard_key:
+                    pools = handle.get_pools()
+                for pool in pools:
+                    QueryCache().configure(cache_namespace(pool, collection),
+                                           **self.__class__._query_cache)
+        self._collection = handle
         self.operate = MongoHelper(self._collection)
 
     def get_collection_name(self):
         return self._collection_name
 
 
+def _local_matches(documents, spec):
+    """`documents` matching `spec`, or None when it uses anything else than
+    equalities and `$in` (mongo would have to tell)."""
+    conditions = []
+    for name, condition in spec.iteritems():
+        if name.startswith('$'):
+            return None
+        if isinstance(condition, dict) and \
+                any(key.startswith('$') for key in condition):
+            if condition.keys() != ['$in']:
+                return None
+            conditions.append((name, condition['$in']))
+        else:
+            conditions.append((name, [condition]))
+
+    def _matches(document):
+        for name, values in conditions:
+            value = get_path(document, name)
+            if value in values:
+                continue
+            # equality matches array items as well
+            if not (isinstance(value, list)
+                    and any(item in values for item in value)):
+                return False
+        return True
+    return [document for document in documents if _matches(document)]
+
+
 class Collection(Persistable):
 
+    # default projection of load/cursor (list of field names), see
+    # apply_projection
+    _fields = None
+
     def __init__(self):
         super(Collection, self).__init__()
         self._data = []
         self.attributes = None
-        self._indexes = {}
+        self._projection = None
+        self._indexes = None
+        self._indexed = None
+        self._complete = False
+        self._count = None
         if self.__class__._collection:
             self._set_collection(self.__class__._collection)
 
@@ -126,52 +860,223 @@ class Collection(Persistable):
         if not isinstance(attributes, dict):
             attributes = {}
         self.attributes = attributes
+        # only known to hold the whole result once it arrived
+        self._complete = False
+        complete = not (kwargs.get('skip') or kwargs.get('limit'))
+        self._projection = apply_projection(kwargs,
+                                            self._get_default_fields())
         self.operate.set_criteria(attributes)
-        self._collection.find(attributes, callback=self._on_load, **kwargs)
+        self._collection.find(attributes, callback=lambda result, error:
+                              self._on_load(result, error, complete),
+                              **kwargs)
 
-    def _on_load(self, result, error):
+    def _on_load(self, result, error, complete=False):
         if not error:
             self._data = result
+            self._complete = complete
+            self._count = None
             self.operate.set_criteria(self.attributes)
         self._callback(collection=self, error=error)
 
+    def cursor(self, attributes=None, batch_size=100, **kwargs):
+        """Returns a `BatchCursor` whose batches are instances of this
+        class (so `Entities` batches hydrate their entities lazily)."""
+        if not isinstance(attributes, dict):
+            attributes = {}
+        self._projection = apply_projection(kwargs,
+                                            self._get_default_fields())
+        return BatchCursor(self._collection, attributes, batch_size,
+                           wrap=self._new_batch, **kwargs)
+
+    def load_batches(self, attributes=None, callback=None, batch_size=100,
+                     **kwargs):
+        """Streaming version of `load`.
+
+        `callback(batch, error, next)` is called once per batch; call
+        `next()` to request the following one. An empty batch means there is
+        nothing left to read.
+        """
+        cursor = self.cursor(attributes, batch_size, **kwargs)
+
+        def _callback(batch, error):
+            callback(batch=batch, error=error,
+                     next=lambda: cursor.next(_callback))
+        cursor.next(_callback)
+
+    def page(self, attributes=None, callback=None, size=20, sort='_id',
+             direction=1, token=None, **kwargs):
+        """Loads a page of `size` items ordered by `sort` (`_id` or any
+        indexed key, ties broken by `_id`), starting after the position
+        encoded in `token` (the first page without it).
+
+        `callback(collection, token, error)` gets the token of the next
+        page, None on the last one. Unlike skip/limit, deep pages cost the
+        same as the first one. Raises InvalidToken for a bad `token`.
+        """
+        if not isinstance(attributes, dict):
+            attributes = {}
+        self.attributes = attributes
+        self._complete = False
+        self._projection = apply_projection(kwargs,
+                                            self._get_default_fields())
+        self.operate.set_criteria(attributes)
+        cursor = BatchCursor(self._collection, attributes, size, token=token,
+                             sort=[(sort, direction)], **kwargs)
+
+        def _callback(result, error):
+            if not error:
+                self._data = result
+                self._count = None
+            callback(collection=self, token=cursor.get_token(), error=error)
+        cursor.next(_callback)
+
+    def walk(self, attributes=None, callback=None, batch_size=100,
+             **kwargs):
+        """Walks every document matching `attributes`, for batch jobs.
+
+        `callback(batch, error, token)` is called per batch (see `cursor`),
+        the next one is requested on the following IOLoop iteration and an
+        empty batch ends the walk (as does an error). Passing the last
+        `token` back as `token` resumes an interrupted walk.
+        """
+        cursor = self.cursor(attributes, batch_size, **kwargs)
+
+        def _callback(batch, error):
+            callback(batch=batch, error=error, token=cursor.get_token())
+            if not error and len(batch):
+                tornado.ioloop.IOLoop.instance().add_callback(
+                    lambda: cursor.next(_callback))
+        cursor.next(_callback)
+
+    def _new_batch(self, documents):
+        batch = self.__class__()
+        if not self.__class__._collection:
+            batch._set_collection(self.get_collection_name())
+        batch.set_items(documents)
+        batch._projection = self._projection
+        return batch
+
+    def _get_default_fields(self):
+        return self.__class__._fields
+
+    def is_partial(self):
+        """True when the items were loaded with a projection."""
+        return self._projection is not None
+
     def count(self, attributes=None, callback=None, **kwargs):
-        def _callback(collection=None, error=None):
-            callback(len(self._data))
-        if len(self._data) > 0:
-            _callback()
-            return
-        self.load(attributes, callback=_callback, **kwargs)
+        """Counts the documents matching `attributes` on the server.
+
+        When this instance already holds the full result for the same
+        criteria, or counted them before, no query is sent at all. A
+        `read_pool` keyword picks the pool the command is sent to.
+        """
+        if not isinstance(attributes, dict):
+            attributes = self.attributes or {}
+        read_pool = kwargs.pop('read_pool', None)
+        if not kwargs:
+            if self._complete and attributes == self.attributes:
+                callback(len(self._data))
+                return
+            if self._count and self._count[0] == attributes:
+                callback(self._count[1])
+                return
+
+        def _callback(result, error):
+            if error or not (result and result.get('ok')):
+                logging.error("count failed on %s: %s",
+                              self._collection_name, error or result)
+                callback(None)
+                return
+            count = int(result['n'])
+            if not kwargs:
+                self._count = (attributes, count)
+            callback(count)
+        self._read_command('count', _callback, read_pool, query=attributes,
+                           **kwargs)
+
+    def distinct(self, attribute, attributes=None, callback=None,
+                 read_pool=None):
+        """Server side distinct values of `attribute` among the documents
+        matching `attributes`, `callback(values, error)`."""
+        if not isinstance(attributes, dict):
+            attributes = {}
+
+        def _callback(result, error):
+            if not error and not (result and result.get('ok')):
+                error = (result or {}).get('errmsg', "distinct failed")
+            callback(result['values'] if not error else [], error)
+        self._read_command('distinct', _callback, read_pool, key=attribute,
+                           query=attributes)
+
+    def _read_command(self, command, callback, read_pool=None, **kwargs):
+        if self.__class__._shard_key:
+            self._collection.command(command, callback, **kwargs)
+        else:
+            send_command(self.get_read_db(read_pool), command,
+                         self._collection_name, callback=callback, **kwargs)
 
     # writing
     def insert(self, items, callback=None):
+        """Inserts `items`, once stored they are added to the loaded ones
+        (indexes included), `callback(collection, error)`."""
         self._callback = callback
         self._items = items
         self._collection.insert(items, callback=self._on_insert)
 
+    def bulk_insert(self, documents, callback=None, **kwargs):
+        """Memory bounded insert of any iterable of documents, which are not
+        kept in this instance, see `BulkInsert` for the options."""
+        if self.__class__._shard_key:
+            raise ValueError("bulk_insert doesn't support sharded models")
+        self._count = None
+        BulkInsert(self.db, self._collection_name, documents, callback,
+                   pool=self.__class__._pool, **kwargs).start()
+
     def _on_insert(self, result, error):
         if not error:
-            self.set_items(self._items)
+            if self._items is not self._data:
+                self.add_items(self._items)
+            self._count = None
         del self._items
         self._callback(self, error)
 
     # deleting
     def remove(self, attributes=None, callback=None, **kwargs):
+        """Removes the documents matching `attributes` (the loaded criteria
+        by default), `callback(result, error)`.
+
+        The removed documents are dropped from the loaded ones (indexes
+        included) when they can be told locally: all of them for the loaded
+        criteria, the matching ones for equalities and `$in` conditions.
+        Other criteria leave the loaded documents untouched.
+        """
         self._callback = callback
+        loaded = self.attributes or {}
         self.attributes = attributes or self.attributes
         if not isinstance(self.attributes, dict):
             self.attributes = {}
-        self._collection.remove(self.attributes, callback=self._on_remove,
+        if self.attributes == loaded:
+            removed = list(self._data)
+        else:
+            removed = _local_matches(self._data, self.attributes)
+        self._collection.remove(self.attributes,
+                                callback=lambda result, error:
+                                    self._on_remove(result, error, removed),
                                 **kwargs)
 
-    def _on_remove(self, result, error):
+    def _on_remove(self, result, error, removed=None):
         self._error = error
+        self._count = None
+        if not error and removed:
+            self.remove_items(removed)
         if callable(self._callback):
             self._callback(result[0], error)
 
     # items
     def set_items(self, items):
         self._data = items
+        self._complete = False
+        self._projection = None
 
     def get_items(self):
         return self._data
@@ -187,25 +1092,50 @@ class Collection(Persistable):
     def get_attributes(self, attribute):
         return map(lambda d: d[attribute], self._data)
 
+    def add_items(self, items):
+        """Appends documents keeping the in-memory indexes up to date."""
+        indexes = self._get_indexes()
+        for item in items:
+            self._data.append(item)
+            indexes.add(item)
+        self._complete = False
+
+    def remove_items(self, items):
+        """Removes (the very same) documents, indexes included."""
+        indexes = self._get_indexes()
+        removed = set()
+        for item in items:
+            removed.add(id(item))
+            indexes.remove(item)
+        self._data[:] = [item for item in self._data
+                         if id(item) not in removed]
+        self._complete = False
+
     # advance getters
+    def _get_indexes(self):
+        # rebuilt (lazily) whenever `_data` is replaced
+        if self._indexed is not self._data:
+            self._indexes = Indexes(self._data)
+            self._indexed = self._data
+        return self._indexes
+
+    def ensure_index(self, *attributes, **kwargs):
+        """Builds an in-memory index on `attributes` (a compound one when
+        several are given), or an ordered one for ranges with
+        `sorted=True`. Indexes are also built on demand by
+        `get_by_attribute`."""
+        if kwargs.get('sorted'):
+            self._get_indexes().get_index(attributes[:1], True)
+        else:
+            self._get_indexes().get_index(tuple(sorted(attributes)))
+
     def get_indexes(self, attribute):
-        if not attribute in self._indexes:
-            self._indexes[attribute] = {}
-            for document in self._data:
-                if attribute in document:
-                    if not document[attribute] in self._indexes[attribute]:
-                        self._indexes[attribute][document[attribute]] = []
-                    self._indexes[attribute][document[attribute]].append(
-                                                                    document)
-        return self._indexes[attribute]
+        return self._get_indexes().group(attribute)
 
     def get_by_attribute(self, **attributes):
-        result = []
-        for key, value in attributes.items():
-            indexes = self.get_indexes(key)
-            if value in indexes:
-                result = result + (indexes[value])
-        return result
+        """Loaded documents matching all the given attributes; values can
+        be `eyestorm.indexes.between` ranges."""
+        return self._get_indexes().find(attributes)
 
     # validation
     def exists(self):
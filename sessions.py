@@ -0,0 +1,336 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sessions stores used by `eyestorm.web.using_session`, the one in use is
+chosen through the `sessions_backend` option.
+"""
+
+
+import calendar
+import json
+import time
+from copy import deepcopy
+from datetime import datetime
+import logging
+
+from bson import ObjectId, json_util
+import tornado.ioloop
+from tornado.options import options
+
+from objects import Db
+from models import Session, Sessions
+from utils import LRUCache
+
+
+def _restore(document):
+    session = Session()
+    session.set_attributes(document, True, True)
+    session.operate.set_criteria(session._id)
+    return session
+
+
+def _new_session(_id=None):
+    session = Session()
+    session._id = ObjectId(_id) if _id else ObjectId()
+    return session
+
+
+def _get_or_set_session_id(handler, session):
+    """Id the session is stored under, the one of the handler's cookie
+    (new sessions take it, the cookie may be set before they are)."""
+    session_id = handler._get_session_id(create=False)
+    if session_id is None:
+        session_id = str(session._id)
+        handler._set_session_id(session_id)
+    elif not session.exists() and str(session._id) != session_id:
+        session._id = ObjectId(session_id)
+    return session_id
+
+
+def get_expiration(value):
+    """Timestamp of an `__expires` value. It is stored as a UTC datetime,
+    so a TTL index can expire the documents; older sessions hold the
+    timestamp itself."""
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value or 0
+
+
+def refresh_expiration(session):
+    """Pushes `__expires` forward, only once less than
+    `sessions_refresh_threshold` of the sessions lifetime remains."""
+    now = int(time.time())
+    lifetime = options.sesssions_lifetime * 60
+    remaining = get_expiration(session.__expires) - now
+    if remaining < lifetime * options.sessions_refresh_threshold:
+        session.__expires = datetime.utcfromtimestamp(now + lifetime)
+
+
+def _is_alive(document):
+    return document and \
+           get_expiration(document.get('__expires')) > time.time()
+
+
+class SessionBackend(object):
+    """Sessions store interface.
+
+    Whatever the store, handlers always get a `Session` entity, so dirty
+    tracking decides whether `save` is called at all.
+    """
+
+    def load(self, handler, callback):
+        """Calls `callback(session)` with the handler's session, a new
+        (not existing) one when it is not stored."""
+        raise NotImplementedError
+
+    def save(self, handler, session, callback):
+        """Stores the session, `callback(error)`."""
+        raise NotImplementedError
+
+    def setup(self):
+        """Called once when the application starts."""
+        pass
+
+    def clean(self):
+        """Drops the expired sessions, called from the periodic
+        `eyestorm.web.sessions_cleaner`."""
+        pass
+
+
+_sessions_cache = None
+
+
+def get_sessions_cache():
+    """Returns the per process sessions cache, an `eyestorm.utils.LRUCache`
+    of session documents by session id (read its `stats()` for hit/miss
+    counters), or None when `sessions_cache_size` is 0.
+    """
+    global _sessions_cache
+    if _sessions_cache is None and options.sessions_cache_size:
+        _sessions_cache = LRUCache(options.sessions_cache_size,
+                                   options.sesssions_lifetime * 60)
+    return _sessions_cache
+
+
+class MongoSessionBackend(SessionBackend):
+    """Sessions stored in `sessions_store_collection`, optionally fronted
+    by the per process cache."""
+
+    def __init__(self):
+        self._ttl = False
+        # expired sessions chunks being removed
+        self._cleaning = 0
+
+    def load(self, handler, callback):
+        session_id = handler._get_session_id(create=False)
+        if session_id is None:
+            callback(_new_session())
+            return
+        cache = get_sessions_cache()
+        document = cache.get(session_id) if cache is not None else None
+        if _is_alive(document):
+            callback(_restore(deepcopy(document)))
+            return
+
+        def _callback(entity, error):
+            if cache is not None and entity.exists():
+                cache.set(session_id, deepcopy(entity.get_attributes()))
+            callback(entity)
+        Session().load(_id=session_id, callback=_callback)
+
+    def save(self, handler, session, callback):
+        session_id = _get_or_set_session_id(handler, session)
+        cache = get_sessions_cache()
+
+        def _callback(error):
+            if cache is not None:
+                if error:
+                    cache.delete(session_id)
+                else:
+                    cache.set(session_id, session.get_attributes())
+            callback(error)
+
+        if session.exists():
+            session.update(lambda result, error: _callback(error))
+        else:
+            # new sessions are inserted, `save` calls back (entity, error)
+            session.save(lambda entity, error: _callback(error))
+
+    def setup(self):
+        shards = options.sessions_shards or None
+        for model in (Session, Sessions):
+            model._shards = shards
+            model._shard_key = '_id' if shards else None
+        pools = shards or [Session._pool]
+        # without the TTL index the sweeps of `clean` still need one
+        index = {'key': {'__expires': 1}, 'name': "__expires"}
+        if not options.sessions_ttl_index:
+            self._create_index(pools, index)
+            return
+
+        pending = [len(pools)]
+
+        def _callback(result, error):
+            if error or not result or not result.get('ok'):
+                logging.warning("Couldn't create the sessions TTL index (%s),"
+                                " falling back to batched cleaning",
+                                error or result)
+                if pending[0] is not None:
+                    self._create_index(pools, index)
+                pending[0] = None
+            elif pending[0]:
+                pending[0] -= 1
+                # expiring is left to mongo once every shard has the index
+                self._ttl = not pending[0]
+        self._create_index(pools, {'key': {'__expires': 1},
+                                   'name': "__expires_ttl",
+                                   'expireAfterSeconds': 0}, _callback)
+
+    def _create_index(self, pools, index, callback=None):
+        def _callback(result, error):
+            if error or not result or not result.get('ok'):
+                logging.warning("Couldn't create the %s sessions index (%s)",
+                                index['name'], error or result)
+        for pool in pools:
+            Db().get_connection(pool).command(
+                                        'createIndexes',
+                                        options.sessions_store_collection,
+                                        indexes=[index],
+                                        callback=callback or _callback)
+
+    def clean(self):
+        if self._cleaning:
+            # the previous sweep is still draining its backlog
+            return
+        # sessions stored before `__expires` became a date are ignored by
+        # the TTL index (numbers and dates never match the same range)
+        self._remove_expired({'__expires': {'$lt': int(time.time())}})
+        if not self._ttl:
+            self._remove_expired({'__expires': {'$lt': datetime.utcnow()}})
+
+    def _remove_expired(self, criteria):
+        """Removes the expired sessions `sessions_clean_batch` at a time,
+        the following chunk being removed on the next IOLoop iteration
+        until a short one shows the backlog is drained."""
+        sessions = Sessions()
+        batch = options.sessions_clean_batch
+        self._cleaning += 1
+
+        def _next():
+            sessions.load(criteria, callback=_on_load, fields=['_id'],
+                          limit=batch)
+
+        def _on_load(collection, error):
+            if error or not len(collection):
+                self._cleaning -= 1
+                return
+            ids = collection.get_attributes('_id')
+            sessions.remove({'_id': {'$in': ids}},
+                            callback=lambda result, error:
+                                _on_remove(result, error, len(ids) >= batch))
+
+        def _on_remove(result, error, full):
+            if result and result['n'] > 0:
+                logging.debug("%i sessions cleaned up!", result['n'])
+            if full and not error:
+                tornado.ioloop.IOLoop.instance().add_callback(_next)
+            else:
+                self._cleaning -= 1
+        _next()
+
+
+class MemorySessionBackend(SessionBackend):
+    """Sessions kept in the process memory, for development or single
+    process deployments. Bounded by `sessions_memory_size`."""
+
+    def __init__(self):
+        self._store = LRUCache(options.sessions_memory_size,
+                               options.sesssions_lifetime * 60)
+
+    def load(self, handler, callback):
+        session_id = handler._get_session_id(create=False)
+        document = self._store.get(session_id) if session_id else None
+        if _is_alive(document):
+            callback(_restore(deepcopy(document)))
+        else:
+            callback(_new_session(session_id))
+
+    def save(self, handler, session, callback):
+        self._store.set(_get_or_set_session_id(handler, session),
+                        deepcopy(session.get_attributes()))
+        session.set_attributes(session.get_attributes(), True, True)
+        callback(None)
+
+
+class CookieSessionBackend(SessionBackend):
+    """Stateless sessions: the whole document travels in a secure (signed)
+    cookie named `sessions_name`, so no database is involved at all.
+
+    Meant for small sessions, browsers drop cookies over ~4KB. As any
+    cookie, the session must be saved before the first `flush()`.
+    """
+
+    max_size = 4000
+
+    def load(self, handler, callback):
+        value = handler.get_secure_cookie(
+                            options.sessions_name,
+                            max_age_days=options.sessions_expiration)
+        document = None
+        if value:
+            try:
+                document = json.loads(value,
+                                      object_hook=json_util.object_hook)
+            except ValueError:
+                logging.warning("Invalid session cookie")
+        if _is_alive(document):
+            callback(_restore(document))
+        else:
+            callback(_new_session())
+
+    def save(self, handler, session, callback):
+        value = json.dumps(session.get_attributes(),
+                           default=json_util.default)
+        if len(value) > self.max_size:
+            callback("session too large for a cookie (%i bytes)" % len(value))
+            return
+        handler.set_secure_cookie(options.sessions_name, value,
+                                  options.sessions_expiration)
+        session.set_attributes(session.get_attributes(), True, True)
+        callback(None)
+
+
+_backends = {'mongo': MongoSessionBackend,
+             'memory': MemorySessionBackend,
+             'cookie': CookieSessionBackend}
+_backend = None
+
+
+def register_session_backend(name, backend):
+    """Makes a `SessionBackend` subclass selectable through the
+    `sessions_backend` option."""
+    _backends[name] = backend
+
+
+def get_session_backend():
+    global _backend
+    if _backend is None:
+        _backend = _backends[options.sessions_backend]()
+    return _backend
@@ -0,0 +1,255 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from bisect import bisect
+from hashlib import md5
+
+from bson import ObjectId
+
+from eyestorm.utils import get_path
+from eyestorm.metrics import send_command
+
+
+class HashRing(object):
+    """Consistent hashing of shard key values over `nodes` (pool names).
+
+    Every node is placed `replicas` times on the ring, so keys spread evenly
+    and adding (or removing) a node only moves the keys of its neighbours.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        points = sorted((self._hash("%s:%i" % (node, replica)), node)
+                        for node in self.nodes
+                        for replica in xrange(replicas))
+        self._hashes = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    @staticmethod
+    def _hash(key):
+        return long(md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        index = bisect(self._hashes, self._hash(str(value)))
+        return self._nodes[index % len(self._nodes)]
+
+
+_rings = {}
+
+
+def get_ring(nodes):
+    """Shared `HashRing` of `nodes`."""
+    nodes = tuple(nodes)
+    if nodes not in _rings:
+        _rings[nodes] = HashRing(nodes)
+    return _rings[nodes]
+
+
+def _gather(calls, merge, callback):
+    """Runs every `call(callback)` at once, then `callback(merge(results),
+    error)` with the first error met."""
+    if not calls:
+        if callable(callback):
+            callback(merge([]), None)
+        return
+    results = [None] * len(calls)
+    state = {'pending': len(calls), 'error': None}
+
+    def _collect(index):
+        def _callback(result, error=None):
+            results[index] = result
+            if error and not state['error']:
+                state['error'] = error
+            state['pending'] -= 1
+            if not state['pending'] and callable(callback):
+                callback(merge(results), state['error'])
+        return _callback
+
+    for index, call in enumerate(calls):
+        call(_collect(index))
+
+
+def _merge_last_errors(results):
+    merged = {'ok': 1.0, 'err': None, 'n': 0}
+    for result in results:
+        for last_error in result or []:
+            merged['n'] += last_error.get('n') or 0
+            if last_error.get('updatedExisting'):
+                merged['updatedExisting'] = True
+            if last_error.get('err') and not merged['err']:
+                merged['err'] = last_error['err']
+    return [merged]
+
+
+def _merge_distinct(results):
+    values = []
+    seen = set()
+    for result in results:
+        for value in (result or {}).get('values', []):
+            try:
+                if value in seen:
+                    continue
+                seen.add(value)
+            except TypeError:
+                # unhashable (embedded documents, lists)
+                if value in values:
+                    continue
+            values.append(value)
+    return {'ok': 1.0, 'values': values}
+
+
+class ShardedCollectionHandle(object):
+    """Stands for the `CollectionHandle` of a collection spread over several
+    pools: each document lives in the pool its `shard_key` value hashes to.
+
+    `handles` and `dbs` are the `CollectionHandle` and the asyncmongo client
+    of every pool. Operations whose spec pins the shard key (equality or
+    `$in`) only reach the pools holding those values; the others are
+    scattered to every pool and gathered: found documents are merged
+    (honouring `sort`, `skip` and `limit`) and write results added up.
+    """
+
+    def __init__(self, name, shard_key, handles, dbs):
+        self._name = name
+        self._shard_key = shard_key
+        self._handles = handles
+        self._dbs = dbs
+        self._ring = get_ring(sorted(handles))
+
+    def _get_value(self, document):
+        if not isinstance(document, dict):
+            # asyncmongo accepts a bare _id as spec
+            document = {'_id': document}
+        if self._shard_key in document:
+            return document[self._shard_key]
+        return get_path(document, self._shard_key)
+
+    def _route(self, spec):
+        """Pools holding the documents matching `spec`."""
+        value = self._get_value(spec or {})
+        if isinstance(value, dict) and isinstance(value.get('$in'), list):
+            return sorted(set(self._ring.get_node(item)
+                              for item in value['$in']))
+        if isinstance(value, (ObjectId, basestring, int, long)):
+            return [self._ring.get_node(value)]
+        return sorted(self._handles)
+
+    def get_pools(self):
+        return sorted(self._handles)
+
+    def get_pool(self, document):
+        """Pool holding `document` (or the documents matching a spec), a
+        ValueError is raised unless it is a single one."""
+        pools = self._route(document)
+        if len(pools) != 1:
+            raise ValueError("Shard key '%s' needed to pick the %s shard"
+                             % (self._shard_key, self._name))
+        return pools[0]
+
+    def _scatter(self, pools, method, args, kwargs, merge, callback):
+        calls = [lambda _callback, pool=pool: getattr(self._handles[pool],
+                 method)(*args, callback=_callback, **kwargs)
+                 for pool in pools]
+        _gather(calls, merge, callback)
+
+    def find(self, spec=None, **kwargs):
+        callback = kwargs.pop('callback')
+        pools = self._route(spec)
+        if len(pools) == 1:
+            self._handles[pools[0]].find(spec, callback=callback, **kwargs)
+            return
+        skip = kwargs.pop('skip', 0)
+        limit = kwargs.pop('limit', 0)
+        if limit:
+            kwargs['limit'] = skip + limit
+        sort = kwargs.get('sort')
+
+        def _merge(results):
+            documents = [document for result in results
+                                  for document in result or []]
+            for key, direction in reversed(sort or []):
+                documents.sort(key=lambda document: get_path(document, key),
+                               reverse=direction < 0)
+            return documents[skip:skip + limit if limit else None]
+        self._scatter(pools, 'find', (spec,), kwargs, _merge, callback)
+
+    def find_one(self, spec=None, **kwargs):
+        callback = kwargs.pop('callback')
+
+        def _merge(results):
+            for result in results:
+                if result is not None:
+                    return result
+        self._scatter(self._route(spec), 'find_one', (spec,), kwargs,
+                      _merge, callback)
+
+    def insert(self, documents, **kwargs):
+        callback = kwargs.pop('callback', None)
+        single = isinstance(documents, dict)
+        batches = {}
+        for document in [documents] if single else documents:
+            pool = self.get_pool(document)
+            batches.setdefault(pool, []).append(document)
+        calls = [lambda _callback, pool=pool, batch=batch: self._handles[pool]
+                 .insert(batch[0] if single else batch, callback=_callback,
+                         **kwargs)
+                 for pool, batch in batches.iteritems()]
+        _gather(calls, _merge_last_errors, callback)
+
+    def update(self, spec, document, **kwargs):
+        callback = kwargs.pop('callback', None)
+        if kwargs.get('upsert'):
+            # the document may not exist yet, its shard must be known
+            pools = [self.get_pool(spec)]
+        else:
+            pools = self._route(spec)
+        self._scatter(pools, 'update', (spec, document), kwargs,
+                      _merge_last_errors, callback)
+
+    def remove(self, spec=None, **kwargs):
+        callback = kwargs.pop('callback', None)
+        self._scatter(self._route(spec), 'remove', (spec,), kwargs,
+                      _merge_last_errors, callback)
+
+    def command(self, command, callback, **kwargs):
+        """Scatters a `count` or `distinct` command about the collection to
+        the shards of its `query` and merges their answers."""
+        if command == 'count':
+            merge = lambda results: {'ok': 1.0, 'n': sum(
+                            (result or {}).get('n', 0) for result in results)}
+        elif command == 'distinct':
+            merge = _merge_distinct
+        else:
+            raise ValueError("Can't scatter the %s command" % command)
+
+        def _call(pool):
+            def call(_callback):
+                def _checked(result, error):
+                    if not error and not (result and result.get('ok')):
+                        error = (result or {}).get('errmsg',
+                                                   "%s failed" % command)
+                    _callback(result, error)
+                send_command(self._dbs[pool], command, self._name,
+                             callback=_checked, **kwargs)
+            return call
+        _gather([_call(pool) for pool in self._route(kwargs.get('query'))],
+                merge, callback)
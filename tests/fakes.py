@@ -0,0 +1,160 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In memory stand-ins for the asyncmongo client and collections (calling
+back synchronously) and for the HTTP connection of a request."""
+
+from copy import deepcopy
+
+from bson import ObjectId
+
+
+def _matches(document, spec):
+    for name, condition in spec.iteritems():
+        value = document.get(name)
+        if isinstance(condition, dict) and condition and \
+                all(key.startswith('$') for key in condition):
+            for operator, argument in condition.iteritems():
+                if operator == '$in' and value not in argument:
+                    return False
+                # like mongo, only values of the same type compare
+                if operator == '$lt' and not (isinstance(value,
+                                                         type(argument))
+                                              and value < argument):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCollection(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.documents = []
+        self.calls = []
+
+    def _find(self, spec):
+        if not isinstance(spec, dict):
+            spec = {'_id': spec}
+        return [document for document in self.documents
+                if _matches(document, spec)]
+
+    def find_one(self, spec, callback=None, **kwargs):
+        self.calls.append(('find_one', spec))
+        found = self._find(spec)
+        callback(deepcopy(found[0]) if found else {}, None)
+
+    def find(self, spec=None, callback=None, limit=0, **kwargs):
+        self.calls.append(('find', spec))
+        found = self._find(spec or {})
+        if limit:
+            found = found[:limit]
+        callback(deepcopy(found), None)
+
+    def insert(self, document, callback=None, **kwargs):
+        self.calls.append(('insert', document))
+        documents = document if isinstance(document, list) else [document]
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+            self.documents.append(deepcopy(document))
+        if callable(callback):
+            callback([{'ok': 1.0, 'err': None, 'n': len(documents)}], None)
+
+    def update(self, spec, document, callback=None, upsert=False,
+               multi=False, **kwargs):
+        self.calls.append(('update', spec, document))
+        found = self._find(spec)
+        if not found and upsert:
+            found = [dict(spec)]
+            self.documents.append(found[0])
+        for stored in found[:None if multi else 1]:
+            if any(key.startswith('$') for key in document):
+                stored.update(deepcopy(document.get('$set', {})))
+                for name in document.get('$unset', {}):
+                    stored.pop(name, None)
+            else:
+                _id = stored['_id']
+                stored.clear()
+                stored.update(deepcopy(document))
+                stored['_id'] = _id
+        if callable(callback):
+            callback([{'ok': 1.0, 'err': None, 'n': len(found)}], None)
+
+    def remove(self, spec, callback=None, **kwargs):
+        self.calls.append(('remove', spec))
+        found = self._find(spec)
+        self.documents = [document for document in self.documents
+                          if document not in found]
+        if callable(callback):
+            callback([{'ok': 1.0, 'err': None, 'n': len(found)}], None)
+
+
+class FakeDb(object):
+    """`Db()._connection` replacement, collections are created on first
+    access; `command` calls are recorded and answered `{'ok': 1}`."""
+
+    def __init__(self):
+        self.collections = {}
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name)
+        return self.collections[name]
+
+    def command(self, command, collection=None, callback=None, **kwargs):
+        self.commands.append((command, collection, kwargs))
+        if callable(callback):
+            callback({'ok': 1.0}, None)
+
+
+class FakeStream(object):
+
+    closed = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+    """HTTP connection of a `tornado.httpserver.HTTPRequest`, keeping what
+    is written."""
+
+    xheaders = False
+
+    def __init__(self):
+        self.stream = FakeStream()
+        self.written = []
+
+    def write(self, chunk, callback=None):
+        self.written.append(chunk)
+        if callback:
+            callback()
+
+    def finish(self):
+        pass
+
+    def get_body(self):
+        return ''.join(self.written).split("\r\n\r\n", 1)[1]
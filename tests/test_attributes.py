@@ -0,0 +1,64 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from bson import ObjectId
+
+from eyestorm.model import Entity, model, is_a, ReferenceOneToOne, \
+                           InvalidAttribute
+
+
+@model
+class Author(Entity):
+    """Doesn't declare its `_id`."""
+
+    _collection = 'authors'
+
+
+@model
+class Post(Entity):
+
+    _collection = 'posts'
+    _attributes = {
+        'author': is_a('Author')
+    }
+
+
+class ReferenceTest(unittest.TestCase):
+
+    def test_reference_to_undeclared_id(self):
+        _id = ObjectId()
+        post = Post()
+        post.author = _id
+        self.assertEqual(post.author, str(_id))
+        self.assertRaises(InvalidAttribute, setattr, post, 'author', "nope")
+
+    def test_undeclared_attribute_is_resolved_on_write(self):
+        # creating the class doesn't fail, the first write does
+        class Review(Entity):
+
+            _attributes = {
+                'author': ReferenceOneToOne('Author', 'code')
+            }
+        self.assertRaises(KeyError, setattr, Review(), 'author', "x")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from eyestorm import objects
+from eyestorm.objects import Collection, WriteBatch
+
+from fakes import FakeDb
+
+
+class Items(Collection):
+
+    _collection = 'items'
+
+
+class CollectionItemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDb()
+        objects.Db()._connection = self.db
+        self.db.items.documents = [{'_id': index, 'kind': kind,
+                                    'tags': [kind]}
+                                   for index, kind in enumerate('aabbc')]
+        self.items = Items()
+        self.items.load({}, callback=lambda collection, error: None)
+        # built before the writes, then maintained incrementally
+        self.items.ensure_index('kind')
+
+    def kinds(self):
+        return [item['kind'] for item in self.items]
+
+    def test_insert_adds_to_the_loaded_items(self):
+        indexes = self.items._get_indexes()
+        self.items.insert([{'kind': 'a'}], callback=lambda *args: None)
+        self.assertTrue(self.items._get_indexes() is indexes)
+        self.assertEqual(self.kinds(), list('aabbca'))
+        self.assertEqual(len(self.items.get_by_attribute(kind='a')), 3)
+
+    def test_remove_equality(self):
+        indexes = self.items._get_indexes()
+        self.items.remove({'kind': 'b'}, callback=lambda *args: None)
+        self.assertTrue(self.items._get_indexes() is indexes)
+        self.assertEqual(self.kinds(), list('aac'))
+        self.assertEqual(self.items.get_by_attribute(kind='b'), [])
+        self.assertEqual(len(self.db.items.documents), 3)
+
+    def test_remove_in_and_array_items(self):
+        self.items.remove({'tags': {'$in': ['a', 'c']}},
+                          callback=lambda *args: None)
+        self.assertEqual(self.kinds(), list('bb'))
+
+    def test_remove_loaded_criteria(self):
+        self.items.remove(callback=lambda *args: None)
+        self.assertEqual(len(self.items), 0)
+
+    def test_remove_other_criteria_keeps_the_items(self):
+        self.items.remove({'_id': {'$gt': 2}}, callback=lambda *args: None)
+        self.assertEqual(self.kinds(), list('aabbc'))
+
+
+class WriteBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDb()
+        objects.Db()._connection = self.db
+        self.batch = WriteBatch()
+        self.batch.max_bytes = 1000
+
+    def tearDown(self):
+        del self.batch.max_bytes
+
+    def test_chunks_are_bounded_by_size(self):
+        results = []
+        for index in xrange(5):
+            self.batch.insert('items', {'index': index, 'data': 'x' * 400},
+                              lambda result, error: results.append(error))
+        self.batch.insert('items', {'index': 5, 'data': 'x' * 2000},
+                          lambda result, error: results.append(error))
+        self.batch.flush()
+        chunks = [[document['index'] for document in kwargs['documents']]
+                  for command, collection, kwargs in self.db.commands]
+        self.assertEqual(chunks, [[0, 1], [2, 3], [4], [5]])
+        self.assertEqual(results, [None] * 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from asyncmongo.errors import TooManyConnections
+from bson import ObjectId
+
+from eyestorm import objects
+from eyestorm.model import Entity
+
+from fakes import FakeDb
+
+
+class Thing(Entity):
+
+    _collection = 'things'
+
+
+class FullPoolCollection(object):
+    """Collection of a pool without any free connection."""
+
+    def __getattr__(self, name):
+        def operation(*args, **kwargs):
+            raise TooManyConnections("too many connections")
+        return operation
+
+
+class DirtyTrackingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDb()
+        self.db.collections['things'] = FullPoolCollection()
+        objects.Db()._connection = self.db
+
+    def stored(self):
+        thing = Thing()
+        thing.set_attributes({'_id': ObjectId(), 'name': u"a", 'size': 1},
+                             True, True)
+        return thing
+
+    def test_update_failing_to_send_keeps_the_changes(self):
+        thing = self.stored()
+        thing.name = u"b"
+        del thing.size
+        self.assertRaises(TooManyConnections, thing.update,
+                          lambda result, error: None)
+        self.assertEqual(thing.get_changes(), set(['name']))
+        self.assertEqual(thing._deleted, {'size': 1})
+
+    def test_insert_failing_to_send_keeps_the_changes(self):
+        thing = Thing()
+        thing.name = u"a"
+        self.assertRaises(TooManyConnections, thing.save,
+                          lambda entity, error: None)
+        self.assertFalse(thing.exists())
+        self.assertTrue('name' in thing.get_changes())
+
+    def test_replace_failing_to_send_keeps_the_changes(self):
+        thing = Thing()
+        thing._id = ObjectId()
+        thing.name = u"a"
+        self.assertRaises(TooManyConnections, thing.save,
+                          lambda entity, error: None, force_update=True)
+        self.assertTrue('name' in thing.get_changes())
+
+
+if __name__ == '__main__':
+    unittest.main()
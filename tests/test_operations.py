@@ -0,0 +1,93 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from eyestorm.objects import MongoOperations
+
+
+def operations():
+    return MongoOperations(None, {})
+
+
+class MongoOperationsTest(unittest.TestCase):
+
+    def test_repeated_operators_are_merged(self):
+        document = operations().inc('a', 1).inc('a', 2).set('b', 1) \
+                               .set('b', 3).get_document()
+        self.assertEqual(document, {'$inc': {'a': 3}, '$set': {'b': 3}})
+
+    def test_pull_all_extends_pull_all(self):
+        document = operations().pullAll('l', [1]).pullAll('l', [2]) \
+                               .get_document()
+        self.assertEqual(document, {'$pullAll': {'l': [1, 2]}})
+
+    def test_pulls_and_pull_all_become_one_pull_all(self):
+        document = operations().pull('l', 1).pull('l', 2) \
+                               .pullAll('l', [3]).get_document()
+        self.assertEqual(document, {'$pullAll': {'l': [1, 2, 3]}})
+
+    def test_pull_then_pull_all_leaves_one_operator(self):
+        document = operations().pull('l', 1).pullAll('l', [2]) \
+                               .get_document()
+        self.assertEqual(document, {'$pullAll': {'l': [1, 2]}})
+
+    def test_pull_conditions_are_not_merged(self):
+        self.assertRaises(ValueError,
+                          operations().pull('l', {'$gt': 3}).pull, 'l', 2)
+        self.assertRaises(ValueError,
+                          operations().pull('l', 1).pull, 'l', {'$in': [2]})
+        self.assertRaises(ValueError, operations().pull('l', {'$in': [2]})
+                                                  .pullAll, 'l', [3])
+
+    def test_push_each_extends_each(self):
+        document = operations().push('l', 1).push('l', {'$each': [2, 3]}) \
+                               .get_document()
+        self.assertEqual(document, {'$push': {'l': {'$each': [1, 2, 3]}}})
+
+    def test_push_each_keeps_modifiers(self):
+        document = operations().push('l', {'$each': [1], '$slice': -5}) \
+                               .push('l', 2).get_document()
+        self.assertEqual(document,
+                         {'$push': {'l': {'$each': [1, 2], '$slice': -5}}})
+        self.assertRaises(ValueError,
+                          operations().push('l', {'$each': [1], '$slice': -5})
+                                      .push, 'l', {'$each': [2], '$slice': 3})
+
+    def test_different_operators_on_one_path_raise(self):
+        self.assertRaises(ValueError, operations().set('a', 1).unset, 'a')
+        self.assertRaises(ValueError, operations().inc('a', 1).set, 'a', 2)
+        self.assertRaises(ValueError, operations().set('a', 1).set, 'a.b', 2)
+        self.assertRaises(ValueError,
+                          operations().pull('l', 1).push, 'l', 2)
+        self.assertRaises(ValueError,
+                          operations().pullAll('l', [1]).addToSet, 'l', 2)
+
+    def test_failed_operator_leaves_the_document_untouched(self):
+        batch = operations().pull('l', 1)
+        self.assertRaises(ValueError, batch.pull, 'l', {'$gt': 3})
+        self.assertEqual(batch.get_document(), {'$pull': {'l': 1}})
+
+    def test_unrelated_paths_do_not_conflict(self):
+        document = operations().set('ab', 1).inc('a', 2).get_document()
+        self.assertEqual(document, {'$set': {'ab': 1}, '$inc': {'a': 2}})
+
+
+if __name__ == '__main__':
+    unittest.main()
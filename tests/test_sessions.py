@@ -0,0 +1,131 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import tornado.ioloop
+import tornado.web
+from tornado.httpserver import HTTPRequest
+from tornado.options import options
+
+from eyestorm import objects, sessions, web
+
+from fakes import FakeDb, FakeConnection
+
+
+class SessionHandler(web.BaseHandler):
+
+    @web.using_session
+    def get(self):
+        if self.get_argument('value', None):
+            # the cookie is set before anything is stored in the session
+            self._get_session_id()
+            self.session.color = self.get_argument('value')
+        self.finish(self.session.color or '')
+
+
+class MongoSessionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDb()
+        objects.Db()._connection = self.db
+        options.sessions_backend = 'mongo'
+        options.sessions_cache_size = 0
+        sessions._backend = None
+        self.application = tornado.web.Application(
+                                            cookie_secret="secret")
+
+    def request(self, uri, cookie=None):
+        headers = {'Cookie': cookie} if cookie else {}
+        connection = FakeConnection()
+        request = HTTPRequest('GET', uri, headers=headers, remote_ip='::1',
+                              connection=connection)
+        handler = SessionHandler(self.application, request)
+        handler._execute([])
+        body = connection.get_body()
+        cookie = getattr(handler, '_new_cookie', {}).get(
+                                                        options.sessions_name)
+        return handler, body, cookie
+
+    def test_new_session_is_stored_under_the_cookie_id(self):
+        handler, output, cookie = self.request('/?value=blue')
+        self.assertTrue(cookie is not None)
+        stored = self.db.collections[options.sessions_store_collection]
+        self.assertEqual([str(document['_id'])
+                          for document in stored.documents],
+                         [handler._get_session_id(create=False)])
+        handler, output, _ = self.request(
+                        '/', "%s=%s" % (options.sessions_name, cookie.value))
+        self.assertEqual(output, 'blue')
+
+
+class SessionsCleaningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDb()
+        objects.Db()._connection = self.db
+        options.sessions_ttl_index = False
+        options.sessions_clean_batch = 500
+        options.sessions_shards = []
+        self.backend = sessions.MongoSessionBackend()
+        self.backend.setup()
+        self.store = getattr(self.db, options.sessions_store_collection)
+        expired = datetime.utcnow() - timedelta(minutes=1)
+        alive = datetime.utcnow() + timedelta(minutes=10)
+        self.store.documents = [{'_id': index, '__expires': expired}
+                                for index in xrange(1200)]
+        self.store.documents.append({'_id': 'alive', '__expires': alive})
+
+    def tearDown(self):
+        options.sessions_ttl_index = True
+
+    def run_until(self, done):
+        io_loop = tornado.ioloop.IOLoop.instance()
+        timeout = io_loop.add_timeout(time.time() + 5, io_loop.stop)
+
+        def _check():
+            if done():
+                io_loop.remove_timeout(timeout)
+                io_loop.stop()
+            else:
+                io_loop.add_callback(_check)
+        io_loop.add_callback(_check)
+        io_loop.start()
+
+    def test_plain_index_without_ttl(self):
+        indexes = [kwargs['indexes'] for command, collection, kwargs
+                   in self.db.commands if command == 'createIndexes']
+        self.assertEqual(indexes, [[{'key': {'__expires': 1},
+                                     'name': "__expires"}]])
+
+    def test_backlog_is_drained_in_chunks(self):
+        self.backend.clean()
+        # one chunk per IOLoop iteration
+        self.assertEqual(len(self.store.documents), 701)
+        self.backend.clean()
+        self.assertEqual(len(self.store.documents), 701)
+        self.run_until(lambda: not self.backend._cleaning)
+        self.assertEqual(self.store.documents[0]['_id'], 'alive')
+        self.assertEqual(len(self.store.documents), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/bin/env python
+#
+# Copyright 2012 Emilio Daniel Gonzalez (@emdagon)
+#
+# This file is part of Eyestorm.
+#
+# Eyestorm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Eyestorm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+
+import tornado.web
+from bson import ObjectId
+from tornado.httpserver import HTTPRequest
+
+from eyestorm import objects, web
+from eyestorm.model import Entity, Entities
+
+from fakes import FakeDb, FakeConnection
+
+
+class Thing(Entity):
+
+    _collection = 'things'
+
+
+class Things(Entities):
+
+    _collection = 'things'
+    _entity = Thing
+
+
+class FakeCursor(object):
+
+    def __init__(self, batches):
+        self._batches = list(batches)
+
+    def next(self, callback):
+        callback(self._batches.pop(0) if self._batches else [], None)
+
+
+class DocumentsResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        objects.Db()._connection = FakeDb()
+        self.ids = [ObjectId() for index in xrange(4)]
+        self.things = Things()
+        self.things.set_items([{'_id': _id, 'index': index}
+                               for index, _id in enumerate(self.ids)])
+        self.connection = FakeConnection()
+        request = HTTPRequest('GET', '/', remote_ip='::1',
+                              connection=self.connection)
+        self.handler = web.BaseHandler(tornado.web.Application(), request)
+        self.handler._transforms = []
+
+    def response(self):
+        return json.loads(self.connection.get_body())
+
+    def test_write_entities_view(self):
+        self.handler.write_documents(self.things[1:3], batch_size=1)
+        self.handler.finish()
+        self.assertEqual(self.response(),
+                         [{'_id': str(self.ids[1]), 'index': 1},
+                          {'_id': str(self.ids[2]), 'index': 2}])
+
+    def test_stream_entities_view(self):
+        errors = []
+
+        def _callback(error):
+            errors.append(error)
+            self.handler.finish()
+        cursor = FakeCursor([self.things[:2], [self.things[3]]])
+        self.handler.stream_documents(cursor, _callback)
+        self.assertEqual(errors, [None])
+        self.assertEqual([document['index']
+                          for document in self.response()], [0, 1, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
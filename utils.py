@@ -18,6 +18,19 @@
 # along with Eyestorm.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
+from bisect import bisect_left
+import time
+from collections import OrderedDict
+
+
+def singleton(cls):
+    instances = {}
+
+    def getinstance():
+        if cls not in instances:
+            instances[cls] = cls()
+        return instances[cls]
+    return getinstance
 
 
 class Struct:
@@ -34,6 +47,123 @@ class Struct:
         self.__dict__[name] = value
 
 
+class LRUCache(object):
+    """Bounded mapping evicting the least recently used entries first.
+
+    Bounded by `max_entries` and, when given, by `max_bytes` (as reported
+    by the `size` passed to `set`). Entries older than their `ttl` (seconds)
+    are treated as missing. Keeps hit/miss/eviction counters, see `stats`.
+    """
+
+    def __init__(self, max_entries=1000, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        value, expires, size = entry
+        if expires is not None and expires < time.time():
+            self.bytes -= size
+            self.misses += 1
+            self.evictions += 1
+            return default
+        self._entries[key] = entry
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None, size=0):
+        ttl = ttl or self.ttl
+        self.delete(key)
+        self._entries[key] = (value, time.time() + ttl if ttl else None, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries \
+                or (self.max_bytes and self.bytes > self.max_bytes):
+            self.bytes -= self._entries.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class Histogram(object):
+    """Counts of the recorded values per bucket, `bounds` being the upper
+    bound of every bucket (the last one takes whatever is above). Cheap to
+    update and fixed in size, percentiles are estimated from the buckets.
+    """
+
+    def __init__(self, bounds=(0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500,
+                               1000, 2000, 5000)):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the `percent` percentile (the
+        max seen for the last bucket)."""
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                break
+        return self.max
+
+    def stats(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'mean': self.total / float(self.count) if self.count else 0,
+                'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'buckets': zip(self.bounds + [None], self.counts)}
+
+
+def get_path(document, key):
+    """Value of the (dotted) `key` in `document`, None when missing."""
+    for name in key.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(name)
+    return document
+
+
 def base64_url_decode(input):
     input += '=' * (4 - (len(input) % 4))
     return base64.urlsafe_b64decode(input.encode('utf-8'))
@@ -25,7 +25,8 @@ and Tornado's handler helpers.
 
 import base64
 import functools
-import time
+import json
+from datetime import datetime, date
 from bson import ObjectId
 import logging
 
@@ -36,7 +37,9 @@ from tornado.options import options
 
 import eyestorm
 
-from models import Session, Sessions
+from model import Entity, ReferenceLoader
+from models import Session
+from sessions import get_session_backend, refresh_expiration
 
 # Dev purposes (will be removed)
 from pprint import pprint
@@ -103,6 +106,27 @@ class route():
         return handler
 
 
+### JSON
+
+def json_default(value):
+    """`json.dumps` default handling the usual mongo values, and entities
+    (their attributes)."""
+    if isinstance(value, Entity):
+        return value.get_attributes()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def _documents(items):
+    # raw documents of collections (entities included), no hydration
+    if hasattr(items, 'get_items'):
+        return items.get_items()
+    return items
+
+
 ### Sessions management
 
 def using_session(method):
@@ -110,7 +134,14 @@ def using_session(method):
 
     Once this decorator is used, the 'self.session' attribute will be setted
     to the handler instance containing an `eyestorm.objects.Entity`. It can be
-    used freely and will be saved automaticly.
+    used freely and will be saved automaticly, where depends on the
+    `sessions_backend` option (see `eyestorm.sessions`).
+
+    The session is only written back when it actually changed; the
+    expiration is refreshed once less than `sessions_refresh_threshold` of
+    its lifetime remains. Visitors without a session cookie get a new
+    session without any read, which is only stored (and the cookie set)
+    once something is put in it.
 
     """
     @functools.wraps(method)
@@ -120,12 +151,11 @@ def using_session(method):
         def _update_expiration():
             if hasattr(self, '__session_updated'):
                 return
-            self.session.__expires = int(time.time()) + \
-                                     (options.sesssions_lifetime * 60)
+            refresh_expiration(self.session)
             self.__session_updated = True
 
-        def _callback(entity, error):
-            self.session = entity
+        def _callback(session):
+            self.session = session
             _update_expiration()
             self._auto_finish = _auto_finish
             self._on_session_loaded()
@@ -136,8 +166,7 @@ def using_session(method):
             method(self, *args, **kwargs)
         else:
             self._auto_finish = False
-            session = Session()
-            session.load(_id=self._get_session_id(), callback=_callback)
+            get_session_backend().load(self, _callback)
 
     return wrapper
 
@@ -145,15 +174,7 @@ def using_session(method):
 @eyestorm.periodic_callback('master', 60000)
 def sessions_cleaner():
     """Sessions expiration maintainer"""
-    timestamp = int(time.time())
-    logging.debug("cleanning sessions... %i", timestamp)
-
-    def _callback(result, error):
-        if result and result['n'] > 0:
-            logging.debug("%i sessions cleaned up!", result['n'])
-    sessions = Sessions()
-    sessions.remove(({'__expires': {'$lt': timestamp}}),
-                    callback=_callback)
+    get_session_backend().clean()
 
 
 # Copied from tornado.web
@@ -187,9 +208,17 @@ class BaseHandler(RequestHandler):
 
     def __init__(self, application, request, **kwargs):
         self.__session_id = None
+        self.__reference_loader = None
         self.session = False
         super(BaseHandler, self).__init__(application, request, **kwargs)
 
+    def get_reference_loader(self):
+        """Request scoped `eyestorm.model.ReferenceLoader`, pass it to
+        `populate` calls so references are loaded once per request."""
+        if self.__reference_loader is None:
+            self.__reference_loader = ReferenceLoader()
+        return self.__reference_loader
+
     def write_cookie(self, name, value):
         value = base64.b64encode(json_encode(value))
         self.set_cookie(name, value)
@@ -200,17 +229,24 @@ class BaseHandler(RequestHandler):
             return json_decode(base64.b64decode(value))
         return default
 
-    def _get_session_id(self):
+    def _get_session_id(self, create=True):
+        """Returns the session id from the sessions cookie. When there is
+        no cookie the cookie is set to the id of the loaded session (a new
+        one when there is no session yet) unless `create` is False, in which
+        case None is returned.
+        """
         if not self.__session_id:
-            self.__session_id = self.get_secure_cookie(options.sessions_name,
-                                                       None)
-            if self.__session_id == None:
-                self.__session_id = str(ObjectId())
-                self._set_session_id(self.__session_id)
+            self.__session_id = self.get_secure_cookie(options.sessions_name)
+            if self.__session_id == None and create:
+                if isinstance(self.session, Session) and self.session._id:
+                    self._set_session_id(str(self.session._id))
+                else:
+                    self._set_session_id(str(ObjectId()))
         return self.__session_id
 
     def _set_session_id(self, value):
         logging.debug("setting cookie: %s", value)
+        self.__session_id = value
         self.set_secure_cookie(options.sessions_name, value,
                                options.sessions_expiration)
 
@@ -230,15 +266,88 @@ class BaseHandler(RequestHandler):
 
     def finish(self, chunk=None):
         if not self._finished and isinstance(self.session, Session):
-            def _callback(entity, error):
+            session = self.session
+
+            def _callback(error):
                 if error:
                     raise Exception("Warning: error saving the session! (%s)" \
                                     % error)
             self._before_session_save()
-            self.session.update(callback=_callback)
+            if session.exists():
+                changed = session.is_dirty()
+            else:
+                # sessions nobody stored anything in are never persisted
+                changed = not session.is_empty()
+            if changed:
+                get_session_backend().save(self, session, _callback)
         super(BaseHandler, self).finish(chunk)
 
 
+    # streaming responses
+    def _write_documents(self, documents, first):
+        for document in documents:
+            if first:
+                first = False
+            else:
+                self.write(",")
+            self.write(json.dumps(document, default=json_default))
+        return first
+
+    def write_documents(self, documents, batch_size=100):
+        """Writes any iterable of documents or entities (a `Collection`,
+        `Entities` or a slice of them included) as a JSON array, encoding
+        document by document and flushing every `batch_size` of them,
+        instead of building the whole response first.
+
+        Whatever sets cookies (like a new session) must happen before, the
+        headers go out with the first flush.
+        """
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write("[")
+        first = True
+        batch = []
+        for document in _documents(documents):
+            batch.append(document)
+            if len(batch) >= batch_size:
+                first = self._write_documents(batch, first)
+                batch = []
+                self.flush()
+        self._write_documents(batch, first)
+        self.write("]")
+
+    def stream_documents(self, cursor, callback=None):
+        """Like `write_documents` for a `eyestorm.objects.BatchCursor`
+        (see `Collection.cursor`): every batch is written and flushed, and
+        the next one is only fetched once the client took it, so memory
+        use does not depend on the result size. `callback(error)` once
+        done, the request is not finished.
+
+        A failing batch closes the connection with the array left open, so
+        clients can't take a truncated response as the whole result.
+        """
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write("[")
+        state = {'first': True}
+
+        def _on_batch(batch, error):
+            if error:
+                logging.error("streaming documents failed: %s", error)
+                self.request.connection.stream.close()
+                if callable(callback):
+                    callback(error)
+                return
+            documents = _documents(batch)
+            if not len(documents):
+                self.write("]")
+                self.flush()
+                if callable(callback):
+                    callback(error)
+                return
+            state['first'] = self._write_documents(documents, state['first'])
+            self.flush(callback=lambda: cursor.next(_on_batch))
+        cursor.next(_on_batch)
+
+
 class CleanHandler(BaseHandler):
     """Register a route pointing to this handler to clean all cookies."""
     def get(self):